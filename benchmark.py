@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cooking_session pipeline on synthetic EPC meter data.
+
+Usage: python benchmark.py --scales 10x30 100x30 --output bench_output.json
+"""
+# Packages
+import argparse
+import json
+import platform
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+import numpy as np
+
+import cooking_session
+
+# Meal slots (start hour, end hour) in which the households start cooking
+MEAL_SLOTS = [(6, 9), (11, 14), (17, 21)]
+
+
+def synthetic_meter_data(
+        n_meters=10,
+        n_days=30,
+        time_resolution=5,
+        gap_rate=0.03,
+        spike_rate=0.002,
+        utc_share=0.0,
+        start='2020-03-09',
+        seed=0):
+    # Recordings as in dataframe_raw.csv: the meters are only turned on while cooking, at most
+    # once per meal slot, and send a recording every time_resolution minutes.
+    # (1) gap_rate: share of recordings that are lost
+    # (2) spike_rate: share of recordings where a spike of 1-5 recordings starts
+    # (3) utc_share: share of meters that send their timestamps in 'UTC+00:00'
+    rng = np.random.default_rng(seed)
+
+    # (a): one row per cooking session
+    n_slots = n_meters * n_days * len(MEAL_SLOTS)
+    session_meter = np.repeat(np.arange(n_meters), n_days * len(MEAL_SLOTS))
+    session_day = np.tile(np.repeat(np.arange(n_days), len(MEAL_SLOTS)), n_meters)
+    slot_start = np.tile([hour for hour, _ in MEAL_SLOTS], n_meters * n_days)
+    slot_length = np.tile([end - hour for hour, end in MEAL_SLOTS], n_meters * n_days)
+    cooking = rng.random(n_slots) < 0.6
+    session_minute = (slot_start * 60 + rng.random(n_slots) * slot_length * 60) // time_resolution * time_resolution
+    session_recordings = rng.integers(3, 25, n_slots)
+    session_power = rng.uniform(0.3, 1.0, n_slots)
+    session_meter, session_day, session_minute, session_recordings, session_power = (
+        column[cooking] for column in (
+            session_meter, session_day, session_minute, session_recordings, session_power))
+
+    # (b): one row per recording
+    session = np.repeat(np.arange(len(session_meter)), session_recordings)
+    step = np.arange(len(session)) - np.repeat(np.cumsum(session_recordings) - session_recordings,
+                                               session_recordings)
+    meter = session_meter[session]
+    minutes = session_day[session] * 1440 + session_minute[session] + step * time_resolution
+    # simmering at low power towards the end of a session
+    simmer = step > 0.7 * session_recordings[session]
+    power = np.where(simmer, 0.1, session_power[session]) * rng.uniform(0.8, 1.0, len(session))
+    power[step == 0] = 0
+
+    keep = rng.random(len(session)) >= gap_rate
+    meter, minutes, power = meter[keep], minutes[keep], power[keep]
+    order = np.lexsort((minutes, meter))
+    meter, minutes, power = meter[order], minutes[order], power[order]
+
+    energy_use = power * time_resolution / 60
+    first_of_meter = np.r_[True, meter[1:] != meter[:-1]]
+    energy_start = rng.uniform(0, 100, n_meters)
+    energy = np.cumsum(energy_use)
+    energy = energy - (energy - energy_use)[first_of_meter][np.cumsum(first_of_meter) - 1] + energy_start[meter]
+
+    # (c): corrupt data spikes due to SIM-card issues, modem changes and grid outages
+    spike_starts = np.flatnonzero(rng.random(len(energy)) < spike_rate)
+    for spike_start, spike_length, spike_size in zip(
+            spike_starts, rng.integers(1, 6, len(spike_starts)), rng.uniform(2, 60, len(spike_starts))):
+        spike = slice(spike_start, spike_start + spike_length)
+        energy[spike] = np.where(meter[spike] == meter[spike_start], energy[spike] + spike_size, energy[spike])
+
+    utc = rng.random(n_meters) < utc_share
+    timestamp = pd.Timestamp(start) + pd.to_timedelta(minutes, unit='m')
+    timestamp = timestamp - pd.to_timedelta(np.where(utc[meter], 3, 0), unit='h')
+    voltage = rng.normal(230, 5, len(energy))
+    df_raw = pd.DataFrame({
+        'id': np.arange(1, len(energy) + 1),
+        'meter_number': 546000 + meter,
+        'timezone': np.where(utc[meter], 'UTC+00:00', 'UTC+03:00'),
+        'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'energy': energy.round(3),
+        'voltage': voltage.round(1),
+        'current': (power * 1000 / voltage).round(3),
+        'power': power.round(3),
+        'power_factor': rng.uniform(0.85, 0.99, len(energy)).round(2),
+        'frequency': rng.normal(50, 0.1, len(energy)).round(2)})
+    return df_raw
+
+
+def pipeline_stages():
+    # The stages of the cooking_session script as (name, function) in the order they run
+    return [
+        ('remove_spikes', cooking_session.remove_spikes),
+        ('cooking_event', cooking_session.cooking_event),
+        ('timestamp_issue', cooking_session.timestamp_issue),
+        ('addtoevent', cooking_session.addtoevent),
+        ('cooking_event_2nd_pass', cooking_session.cooking_event),
+        ('only_events', cooking_session.only_events),
+        ('period', cooking_session.period)]
+
+
+def run_stages(df_raw, trace_memory=False):
+    # Run the stages once, with the wall time and (if trace_memory) the peak memory of each stage
+    results = []
+    df = df_raw.copy()
+    for stage, function in pipeline_stages():
+        rows_in = len(df)
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        df = function(df)
+        seconds = time.perf_counter() - start
+        result = {'stage': stage, 'seconds': seconds, 'rows_in': rows_in, 'rows_out': len(df)}
+        if trace_memory:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append(result)
+    return results
+
+
+def benchmark(scales, repeat=3, seed=0, utc_share=0.2):
+    # Wall time (best of repeat) and peak memory of each stage, for each (n_meters, n_days) in scales
+    report = {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'commit': git_commit(),
+        'results': []}
+    for n_meters, n_days in scales:
+        df_raw = synthetic_meter_data(n_meters, n_days, utc_share=utc_share, seed=seed)
+        stages = run_stages(df_raw, trace_memory=True)
+        for _ in range(repeat):
+            for stage, timed in zip(stages, run_stages(df_raw)):
+                stage['seconds'] = min(stage['seconds'], timed['seconds'])
+        report['results'].append({
+            'n_meters': n_meters,
+            'n_days': n_days,
+            'rows': len(df_raw),
+            'raw_bytes': int(df_raw.memory_usage(deep=True).sum()),
+            'total_seconds': sum(stage['seconds'] for stage in stages),
+            'stages': stages})
+    return report
+
+
+def lean_peak_ratio(df_raw):
+    # Peak memory of run_pipeline(..., lean=True) on df_raw written to and read from a CSV file, as a
+    # multiple of the memory of the recordings as read from the file
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'dataframe_raw.csv')
+        df_raw.to_csv(path, index=False)
+        raw_bytes = pd.read_csv(path).memory_usage(deep=True).sum()
+        tracemalloc.start()
+        cooking_session.run_pipeline(path, lean=True)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak / raw_bytes
+
+
+def git_commit():
+    # The commit of this repository, also when the benchmark runs from another directory
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scale(text):
+    # '100x30' -> (100, 30), i.e. 100 meters over 30 days
+    n_meters, n_days = text.lower().split('x')
+    return int(n_meters), int(n_days)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scales', nargs='+', type=scale, default=[(10, 30), (50, 30), (100, 60)],
+                        help='meters x days, e.g. 100x30')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scale, the best is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--utc-share', type=float, default=0.2, help="share of meters in 'UTC+00:00'")
+    parser.add_argument('--output', help='JSON file, printed if not given')
+    parser.add_argument('--check-lean', action='store_true',
+                        help='only check the peak memory of the lean mode against LEAN_MEMORY_TARGET')
+    args = parser.parse_args(argv)
+
+    if args.check_lean:
+        failed = False
+        for n_meters, n_days in args.scales:
+            ratio = lean_peak_ratio(synthetic_meter_data(n_meters, n_days, utc_share=args.utc_share, seed=args.seed))
+            failed |= ratio > cooking_session.LEAN_MEMORY_TARGET
+            print('{}x{}: peak memory {:.2f} times the input (target {})'.format(
+                n_meters, n_days, ratio, cooking_session.LEAN_MEMORY_TARGET))
+        sys.exit(1 if failed else 0)
+
+    report = benchmark(args.scales, repeat=args.repeat, seed=args.seed, utc_share=args.utc_share)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,41 +6,393 @@ Created on Sun Dec 20 08:30:08 2020
 @author: Mattias Nilsson
 """
 # Packages
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import re
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial, wraps
+
 import pandas as pd
 import numpy as np
 
-
-def remove_spikes(df_raw, min_size_of_spikes=1):
-    # (1) Why range(100)?: There are more than 50 recordings in some of the spikes.
-    # (2) Why not drop rows?: To save the dates of when the spikes occur.
-    # (3) Why min_size_of_spikes? = To avoid losing small energy movements, incl. timestamp issue.
-    for _ in range(100):
-        df_raw.loc[(df_raw.energy > df_raw.energy.shift(-1) + min_size_of_spikes) &
-                   (df_raw.meter_number == df_raw.meter_number.shift(-1)), 'energy'] = df_raw.energy.shift(-1)
+try:
+    from numba import njit
+except ImportError:  # numba is optional, conditions_kernel then runs on NumPy only
+    njit = None
+
+# The active trace() as a dict with its report, None when tracing is disabled
+TRACE = None
+
+
+@contextmanager
+def trace(memory=False, chrome_trace=None):
+    # (1) Why opt-in?: While TRACE is None, the stages, the steps of cooking_event and the rules of
+    # event_conditions only check it and run as before, so the overhead of a disabled trace is a
+    # function call per stage and rule.
+    # (2) The report has one record per stage, step and rule call, with wall time, rows in/out, the
+    # number of rows the call flipped (rules only) and, if memory, the change of the memory allocated
+    # by Python and NumPy (tracemalloc). 'summary' adds them up per name.
+    # (3) chrome_trace: file to also write the records to, for chrome://tracing or Perfetto.
+    # Only the calling process is traced, i.e. not the workers of parallel_meters.
+    global TRACE
+    report = {'records': [], 'summary': []}
+    previous = TRACE
+    start_tracemalloc = memory and not tracemalloc.is_tracing()
+    if start_tracemalloc:
+        tracemalloc.start()
+    TRACE = {'report': report, 'memory': memory, 'start': time.perf_counter()}
+    try:
+        yield report
+    finally:
+        TRACE = previous
+        if start_tracemalloc:
+            tracemalloc.stop()
+        report['summary'] = summarize_trace(report['records'])
+        if chrome_trace is not None:
+            write_chrome_trace(report, chrome_trace)
+
+
+@contextmanager
+def span(name, category, df, columns=()):
+    # Record the code in the with-block as name in the active trace. columns: the columns of df set
+    # by a rule, to count the rows whose value it flipped. Yields a dict where 'rows_out' can be set
+    # if the rows out are not those of df.
+    if TRACE is None:
+        yield {}
+        return
+    before = [df[column].to_numpy(copy=True) if column in df.columns else None for column in columns]
+    record = {'name': name, 'category': category, 'rows_in': len(df)}
+    TRACE['report']['records'].append(record)
+    memory_start = tracemalloc.get_traced_memory()[0] if TRACE['memory'] else None
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['start'] = start - TRACE['start']
+    record.setdefault('rows_out', len(df))
+    if memory_start is not None:
+        record['memory_delta'] = tracemalloc.get_traced_memory()[0] - memory_start
+    if columns:
+        flipped = np.zeros(len(df), dtype=bool)
+        for column, values in zip(columns, before):
+            after = df[column].to_numpy()
+            if values is None:
+                flipped |= ~pd.isna(after)
+            else:
+                flipped |= (values != after) & ~(pd.isna(values) & pd.isna(after))
+        record['rows_flipped'] = int(flipped.sum())
+
+
+def traced(stage):
+    # Decorator to record each call of a stage of the script in the active trace
+    def decorator(function):
+        @wraps(function)
+        def wrapper(df, *args, **kwargs):
+            if TRACE is None:
+                return function(df, *args, **kwargs)
+            with span(stage, 'stage', df) as record:
+                result = function(df, *args, **kwargs)
+                record['rows_out'] = len(result[0] if isinstance(result, tuple) else result)
+            return result
+        return wrapper
+    return decorator
+
+
+def summarize_trace(records):
+    # Total wall time, rows and flipped rows per (category, name), in the order of the first call
+    summary = {}
+    for record in records:
+        total = summary.setdefault((record['category'], record['name']), {
+            'name': record['name'], 'category': record['category'], 'calls': 0, 'seconds': 0.0,
+            'rows_in': 0, 'rows_out': 0})
+        total['calls'] += 1
+        for key in ('seconds', 'rows_in', 'rows_out', 'rows_flipped', 'memory_delta'):
+            if key in record:
+                total[key] = total.get(key, 0) + record[key]
+    return list(summary.values())
+
+
+def write_chrome_trace(report, path):
+    # The records as complete events ('ph': 'X') of the Chrome trace event format, in microseconds
+    events = [{'name': record['name'], 'cat': record['category'], 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+               'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6,
+               'args': {key: value for key, value in record.items()
+                        if key not in ('name', 'category', 'start', 'seconds')}}
+              for record in report['records']]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# The active stage_cache() as a dict, None when caching is disabled
+CACHE = None
+
+
+@contextmanager
+def stage_cache(path='.stage_cache', max_bytes=2 * 1024 ** 3):
+    # (1) What?: The stages called in the with-block (see cached) read their result from path if they
+    # ran with the same input, parameters and code before, and write it there otherwise. Yields a
+    # dict with the number of 'hits' and 'misses'.
+    # (2) The key of a result is a hash of the stage, the content of the input frame (all values,
+    # columns, dtypes and index), the parameters and the code (this file and the pandas version),
+    # so that a change of any of them is a miss.
+    # (3) The results are Arrow IPC (Feather) files, compressed with LZ4, which are read much
+    # faster than Parquet or CSV. When they take more than max_bytes, the least recently used
+    # ones are deleted.
+    # Only the calling process uses the cache, i.e. not the workers of parallel_meters or sweep.
+    global CACHE
+    os.makedirs(path, exist_ok=True)
+    evict_cache(path, max_bytes)
+    with open(__file__, 'rb') as f:
+        version = hashlib.sha256(f.read() + pd.__version__.encode()).hexdigest()
+    stats = {'hits': 0, 'misses': 0}
+    previous = CACHE
+    CACHE = {'path': path, 'max_bytes': max_bytes, 'version': version, 'stats': stats}
+    try:
+        yield stats
+    finally:
+        CACHE = previous
+
+
+def cached(stage):
+    # Decorator to look up the result of a stage in the active stage_cache(). Only DataFrame results
+    # are cached. 'copy' is not part of the key, and the input frame isn't changed on a hit.
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(df, *args, **kwargs):
+            if CACHE is None:
+                return function(df, *args, **kwargs)
+            arguments = signature.bind(df, *args, **kwargs)
+            arguments.apply_defaults()
+            params = {name: value for name, value in list(arguments.arguments.items())[1:] if name != 'copy'}
+            key = cache_key(stage, df, params)
+            path = os.path.join(CACHE['path'], key + '.arrow')
+            if os.path.exists(path):
+                CACHE['stats']['hits'] += 1
+                os.utime(path)
+                return read_cached(path)
+            CACHE['stats']['misses'] += 1
+            result = function(df, *args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                write_cached(result, path)
+                evict_cache(CACHE['path'], CACHE['max_bytes'])
+            return result
+        return wrapper
+    return decorator
+
+
+def cache_key(stage, df, params):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage, CACHE['version'], list(map(str, df.columns)), list(map(str, df.dtypes)),
+                              list(map(str, df.index.names)), params], default=str, sort_keys=True).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def read_cached(path):
+    import pyarrow.feather
+    return pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+
+
+def write_cached(df, path):
+    # Written to a temporary file first, so that an interrupted write is never read
+    import pyarrow
+    import pyarrow.feather
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    pyarrow.feather.write_feather(pyarrow.Table.from_pandas(df), temporary, compression='lz4')
+    os.replace(temporary, path)
+
+
+def evict_cache(path, max_bytes):
+    # Delete the least recently used results (by modification time, which a hit updates) until the
+    # others take at most max_bytes
+    entries = []
+    for name in os.listdir(path):
+        if name.endswith('.arrow'):
+            stat = os.stat(os.path.join(path, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, name in sorted(entries):
+        if size <= max_bytes:
+            break
+        os.remove(os.path.join(path, name))
+        size -= entry_size
+
+
+@traced('remove_spikes')
+def remove_spikes(df_raw, min_size_of_spikes=1, return_corrected=False, max_passes=100):
+    # (1) Why max_passes=100?: A recording that is more than min_size_of_spikes above the next one of
+    # the same meter is set to it, once per pass, as in the 100 passes of the script. A spike of n
+    # recordings is corrected from its end in n passes (there are more than 50 recordings in some of
+    # them), so at most 100 recordings before a drop of the energy are changed, also when the drop is
+    # a reset of the counter or a swapped meter. max_passes=None corrects spikes of any length, but
+    # then such a drop flattens all earlier recordings of the meter (and their cooking events).
+    # (2) Why the reversed cumulative minimum?: A recording can only be changed if its energy is more
+    # than min_size_of_spikes above the lowest later recording of the same meter, so the passes only
+    # run over those candidates, and stop when nothing changes.
+    # (3) Why not drop rows?: To save the dates of when the spikes occur.
+    # (4) Why min_size_of_spikes? = To avoid losing small energy movements, incl. timestamp issue.
+    meter_run = (df_raw.meter_number != df_raw.meter_number.shift()).cumsum()
+    energy = df_raw.energy.to_numpy(dtype=float, copy=True)
+    later_min = df_raw.energy[::-1].groupby(meter_run[::-1]).cummin()[::-1].to_numpy(dtype=float)
+
+    # a candidate is never the last recording of a meter
+    candidates = np.flatnonzero(energy > later_min + min_size_of_spikes)
+    corrected = np.zeros(len(energy), dtype=bool)
+    if max_passes is None:
+        # from the end of each meter, energy[i + 1] is already final
+        for i in candidates[::-1]:
+            if energy[i] > energy[i + 1] + min_size_of_spikes:
+                energy[i] = energy[i + 1]
+                corrected[i] = True
+    else:
+        for _ in range(max_passes):
+            spike = candidates[energy[candidates] > energy[candidates + 1] + min_size_of_spikes]
+            if not len(spike):
+                break
+            # all recordings of a pass are set to the next ones as they were before the pass
+            energy[spike] = energy[spike + 1]
+            corrected[spike] = True
+
+    df_raw['energy'] = energy
+    if return_corrected:
+        # number of corrected recordings per meter_number
+        corrected_rows = df_raw.meter_number[corrected].value_counts().sort_index()
+        corrected_rows.name = 'corrected_rows'
+        return df_raw, corrected_rows
     return df_raw
 
 
-def cooking_event(
-        df_raw,
-        min_cooking_event=0.05,
-        power_mean_min=0.05):
-
-    df_processed = df_raw.copy()
-
-    # Format 'timestamp' column
-    if 'timestamp' in df_processed.columns:
-        df_processed.timestamp = pd.to_datetime(df_processed.timestamp)
-        df_processed.timestamp = np.int64(df_processed.timestamp)
-        df_processed.timestamp = pd.to_datetime(df_processed.timestamp)
-    else:
+def group_first(key, values, last=False):
+    # First (or last) non-null value of each group of key, broadcast to the rows of the group as
+    # by key.map(dict). Rows where key is NaN get NaN. Uses integer group codes instead of a dict.
+    codes = pd.factorize(key)[0]
+    first = values.groupby(codes).transform('last' if last else 'first')
+    return first.where(codes >= 0)
+
+
+def lookup(key, table_key, table_values):
+    # The values of table_values for each row of key, as by key.map(dict(zip(table_key, table_values))),
+    # via the integer positions of key in table_key. Rows not in table_key get NaN.
+    unique = ~table_key.duplicated(keep='last').to_numpy()
+    positions = pd.Index(table_key[unique]).get_indexer(key)
+    table = table_values[unique].reset_index(drop=True)
+    return pd.Series(table.reindex(positions).to_numpy(), index=key.index)
+
+
+def event_groups(meter_number, cooking_event):
+    # The cooking events as integer groups instead of groupby(['meter_number', 'cooking_event']):
+    # the positions of the rows with a cooking event, grouped in the order of (meter_number,
+    # cooking_event) and in their order within each group, and the offset of each group in them.
+    # Rows that are sorted already (as by cooking_event) are grouped in one pass, others by a
+    # stable sort.
+    meter_number = meter_number.to_numpy(dtype=float, na_value=np.nan)
+    cooking_event = cooking_event.to_numpy(dtype=float, na_value=np.nan)
+    rows = np.flatnonzero(~np.isnan(cooking_event))
+    meter, event = meter_number[rows], cooking_event[rows]
+    if not np.all((meter[1:] > meter[:-1]) | ((meter[1:] == meter[:-1]) & (event[1:] >= event[:-1]))):
+        order = np.lexsort((event, meter))
+        rows, meter, event = rows[order], meter[order], event[order]
+    starts = np.flatnonzero(np.concatenate([[True], (meter[1:] != meter[:-1]) | (event[1:] != event[:-1])]))
+    return rows, starts[:len(rows)]
+
+
+def event_reduce(ufunc, values, starts):
+    # ufunc.reduceat over the groups of event_groups (values in the order of its rows)
+    return ufunc.reduceat(values, starts) if len(starts) else values[:0]
+
+
+def event_sum(values, starts):
+    # The sum and number of the non-null values of each group of event_groups, by the compensated
+    # (Kahan) summation of pandas, so that sum / number equals groupby(...).mean() exactly. The
+    # groups are summed all together, one row of each at a time.
+    lengths = np.diff(np.append(starts, len(values)))
+    total = np.zeros(len(starts), dtype=values.dtype)
+    compensation = np.zeros(len(starts), dtype=values.dtype)
+    number = np.zeros(len(starts), dtype=np.int64)
+    groups = np.arange(len(starts))
+    for row in range(lengths.max() if len(lengths) else 0):
+        groups = groups[lengths[groups] > row]
+        value = values[starts[groups] + row]
+        is_value = ~np.isnan(value)
+        group, value = groups[is_value], value[is_value]
+        number[group] += 1
+        y = value - compensation[group]
+        t = total[group] + y
+        compensation[group] = t - total[group] - y
+        total[group] = t
+    return total, number
+
+
+# The timezone of the timestamps after normalize_timestamps (East Africa Time)
+LOCAL_TIMEZONE = 'UTC+03:00'
+
+# The format of 'timestamp' in dataframe_raw.csv
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_timestamps(timestamp):
+    # 'timestamp' as datetime64[ns] without timezone. Strings are parsed once with TIMESTAMP_FORMAT
+    # (other formats are inferred), datetimes are kept, and datetimes with a timezone are converted
+    # to UTC, as the former round trip through np.int64 did.
+    if pd.api.types.is_datetime64tz_dtype(timestamp):
+        return timestamp.dt.tz_convert(None)
+    if pd.api.types.is_datetime64_dtype(timestamp):
+        return timestamp
+    try:
+        return pd.to_datetime(timestamp, format=TIMESTAMP_FORMAT)
+    except (ValueError, TypeError):
+        return pd.to_datetime(timestamp, cache=True)
+
+
+def timezone_offset(timezone):
+    # The offset of a timezone as 'UTC+03:00' in minutes, NaN if it isn't in this form
+    match = re.fullmatch(r'UTC([+-])(\d{2}):(\d{2})', str(timezone))
+    if match is None:
+        return np.nan
+    sign, hours, minutes = match.groups()
+    return (1 if sign == '+' else -1) * (int(hours) * 60 + int(minutes))
+
+
+@traced('normalize_timestamps')
+def normalize_timestamps(df):
+    # In place: 'timestamp' parsed (see parse_timestamps) and shifted from the 'timezone' of each row
+    # to LOCAL_TIMEZONE, which becomes their 'timezone'.
+    # (1) Why per row?: Meters in 'UTC+00:00' are shifted by +3 hours and the others not. The whole
+    # frame was shifted if one row was in 'UTC+00:00' (which the regular expression of
+    # str.contains('UTC+00:00') never found, as '+' is a quantifier there).
+    # (2) Each distinct 'timezone' is parsed once, as the categories of the column, and the offsets
+    # are taken by the category codes of the rows. Rows without a timezone in the form 'UTC+03:00'
+    # are not shifted.
+    df.timestamp = parse_timestamps(df.timestamp)
+    zones = df.timezone if isinstance(df.timezone.dtype, pd.CategoricalDtype) else df.timezone.astype('category')
+    offsets = np.array([timezone_offset(zone) for zone in zones.cat.categories] + [np.nan])
+    shift = timezone_offset(LOCAL_TIMEZONE) - offsets[zones.cat.codes.to_numpy()]
+    shifted = ~np.isnan(shift) & (shift != 0)
+    if shifted.any():
+        df.timestamp += pd.to_timedelta(np.where(shifted, shift, 0), unit='m')
+        if isinstance(df.timezone.dtype, pd.CategoricalDtype) and LOCAL_TIMEZONE not in df.timezone.cat.categories:
+            df.timezone = df.timezone.cat.add_categories([LOCAL_TIMEZONE])
+        df.loc[shifted, 'timezone'] = LOCAL_TIMEZONE
+    return df
+
+
+def prepare_timestamps(df_processed):
+    # The first step of cooking_event, in place: the timestamps in LOCAL_TIMEZONE (see
+    # normalize_timestamps) and their differences within each meter_number. It only depends on the
+    # recordings, see sweep.
+    if 'timestamp' not in df_processed.columns:
         df_processed.reset_index(inplace=True)
-
-    # Check 'UTC+00:00' in column 'timezone'
-    boolean_zone = df_processed['timezone'].str.contains('UTC+00:00').any()
-    if boolean_zone:
-        # adding +3 hr to timestamp
-        df_processed.timestamp += pd.Timedelta(hours=3)
-        df_processed.timezone = 'UTC+03:00'
+    normalize_timestamps(df_processed)
 
     # Create columns based on columns 'meter_number' and 'timestamp' by
     # selecting the time difference between rows for each meter_number to
@@ -49,81 +401,106 @@ def cooking_event(
                      'diff_prev_timestamp'] = df_processed.timestamp.diff()
     df_processed.loc[(df_processed.meter_number.diff(-1) == 0),
                      'diff_next_timestamp'] = df_processed.timestamp.shift(-1) - df_processed.timestamp
+    return df_processed
+
+
+@traced('cooking_event')
+@cached('cooking_event')
+def cooking_event(
+        df_raw,
+        min_cooking_event=0.05,
+        power_mean_min=0.05,
+        engine='pandas',
+        min_active_load=0.15,
+        power_capacity=1,
+        time_resolution=5,
+        t_between=15,
+        copy=True,
+        prepared=False):
+
+    if engine not in ('pandas', 'numpy'):
+        raise ValueError("engine must be 'pandas' or 'numpy', not {!r}".format(engine))
+
+    # copy=False adds the columns to df_raw itself (see lean_session), prepared=True skips
+    # prepare_timestamps for recordings that went through it already (see sweep)
+    df_processed = df_raw.copy() if copy else df_raw
+
+    # Format 'timestamp' column
+    with span('cooking_event: timestamps', 'step', df_processed):
+        if not prepared:
+            prepare_timestamps(df_processed)
 
     # Create columns for Cooking 'start' & 'end'
     df_processed['cooking_start'] = False
     df_processed['cooking_end'] = False
 
     # Create distinct cooking events
-    df_processed = event_conditions(df_processed)
+    if engine == 'numpy':
+        df_processed = event_conditions_numpy(
+            df_processed, min_active_load, power_capacity, time_resolution, t_between)
+    else:
+        df_processed = event_conditions(
+            df_processed, min_active_load, power_capacity, time_resolution, t_between)
 
     # Create a column 'cooking_event' for accumulated numbering of cooking
     # events
-    df_processed['cooking_event'] = 0
-    df_processed.cooking_event += df_processed['cooking_start']
-    df_processed.cooking_event = df_processed['cooking_event'].cumsum()
-
-    # Create columns to show start & end timestamp of each cooking event
-    start_cooking = df_processed.groupby('cooking_event').first()
-    start_cooking.reset_index(inplace=True)
-    df_processed['time_start'] = df_processed.cooking_event.map(
-        start_cooking.set_index('cooking_event')['timestamp'].to_dict())
-    df_processed['energy_start'] = df_processed.cooking_event.map(
-        start_cooking.set_index('cooking_event')['energy'].to_dict())
-
-    end_cooking = df_processed.copy()
-    end_cooking = end_cooking.loc[(end_cooking['cooking_end'])]
-    end_cooking = end_cooking.groupby(['cooking_event']).first()
-    end_cooking_lack_regular_endpoint = df_processed.copy()
-    end_cooking_lack_regular_endpoint = end_cooking_lack_regular_endpoint.groupby([
-                                                                                  'cooking_event']).last()
-    end_cooking = end_cooking.append(end_cooking_lack_regular_endpoint)
-    end_cooking.reset_index(inplace=True)
-
-    df_processed['time_end'] = df_processed.cooking_event.map(
-        end_cooking.set_index('cooking_event')['timestamp'].to_dict())
-    df_processed['energy_end'] = df_processed.cooking_event.map(
-        end_cooking.set_index('cooking_event')['energy'].to_dict())
-
-    df_processed.loc[((df_processed.timestamp > df_processed.time_end)
-                      ), 'cooking_event'] = np.nan
-
-    df_processed.loc[((df_processed.timestamp > df_processed.time_end)
-                      ), 'time_start'] = np.nan
+    with span('cooking_event: numbering', 'step', df_processed):
+        df_processed['cooking_event'] = 0
+        df_processed.cooking_event += df_processed['cooking_start']
+        df_processed.cooking_event = df_processed['cooking_event'].cumsum()
+
+        # Create columns to show start & end timestamp of each cooking event
+        df_processed['time_start'] = group_first(df_processed.cooking_event, df_processed.timestamp)
+        df_processed['energy_start'] = group_first(df_processed.cooking_event, df_processed.energy)
+
+        # The end is the last row of each cooking event (which always took precedence over the first
+        # row with 'cooking_end')
+        df_processed['time_end'] = group_first(df_processed.cooking_event, df_processed.timestamp, last=True)
+        df_processed['energy_end'] = group_first(df_processed.cooking_event, df_processed.energy, last=True)
+
+        df_processed.loc[((df_processed.timestamp > df_processed.time_end)
+                          ), 'cooking_event'] = np.nan
+
+        df_processed.loc[((df_processed.timestamp > df_processed.time_end)
+                          ), 'time_start'] = np.nan
 
     # Create columns for getting duration of cooking event and sequence time
     # during cooking event
-    df_processed['cooking_time'] = (
-        df_processed.time_end - df_processed.time_start) / np.timedelta64(1, 'm')
-    df_processed['seq_time'] = (
-        df_processed.timestamp - df_processed.time_start) / np.timedelta64(1, 'm')
+    with span('cooking_event: durations', 'step', df_processed):
+        df_processed['cooking_time'] = (
+            df_processed.time_end - df_processed.time_start) / np.timedelta64(1, 'm')
+        df_processed['seq_time'] = (
+            df_processed.timestamp - df_processed.time_start) / np.timedelta64(1, 'm')
 
     # Disqualify too short cooking events
-    df_processed.loc[
-        (
-            (df_processed.cooking_event != df_processed.cooking_event.shift())
-            & (df_processed.cooking_event != df_processed.cooking_event.shift(-1))
-            & (df_processed.energy.diff() < min_cooking_event)
-        ), 'cooking_event'] = np.nan
+    with span('cooking_event: disqualify', 'step', df_processed, ['cooking_event']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_event != df_processed.cooking_event.shift())
+                & (df_processed.cooking_event != df_processed.cooking_event.shift(-1))
+                & (df_processed.energy.diff() < min_cooking_event)
+                & (df_processed.meter_number == df_processed.meter_number.shift())
+            ), 'cooking_event'] = np.nan
 
-    # Disqualify cooking events of 'too low' average energy
-    df_processed.loc[((df_processed.energy_end -
-                       df_processed.energy_start < min_cooking_event) | ((df_processed.energy_end -
-                                                                          df_processed.energy_start) /
-                                                                         (df_processed.cooking_time /
-                                                                          60) < power_mean_min)), 'cooking_event'] = np.nan
+        # Disqualify cooking events of 'too low' average energy
+        df_processed.loc[((df_processed.energy_end -
+                           df_processed.energy_start < min_cooking_event) | ((df_processed.energy_end -
+                                                                              df_processed.energy_start) /
+                                                                             (df_processed.cooking_time /
+                                                                              60) < power_mean_min)), 'cooking_event'] = np.nan
 
-    df_processed.set_index('timestamp', inplace=True)
+        df_processed.set_index('timestamp', inplace=True)
 
-    df_processed.loc[((df_processed.cooking_event.isnull())
-                      ), 'cooking_time'] = np.nan
+        df_processed.loc[((df_processed.cooking_event.isnull())
+                          ), 'cooking_time'] = np.nan
 
-    df_processed.loc[((df_processed.cooking_event.isnull())
-                      ), 'seq_time'] = np.nan
+        df_processed.loc[((df_processed.cooking_event.isnull())
+                          ), 'seq_time'] = np.nan
 
     return df_processed
 
 
+@traced('event_conditions')
 def event_conditions(df_processed,
                      min_active_load=0.15,
                      power_capacity=1,
@@ -135,198 +512,360 @@ def event_conditions(df_processed,
     energy_threshold = power_threshold * time_resolution / 60
 
     # (ii): Create column 'load' for when a load is applied.
-    df_processed.loc[(
-        (
-            (df_processed.energy.diff() > energy_threshold)
-            | (df_processed.power > min_active_load * power_capacity))
-        & (df_processed.meter_number == df_processed.meter_number.shift())
-    ), 'load'] = df_processed.energy.diff()
-
-    # (iii): Create a column 'load_count' for accumulated numbering of when a load is applied.
-    df_processed['load_count'] = 0  # start
-    df_processed.loc[(df_processed.load.isnull()
-                      == False), 'load_count'] += 1
-    df_processed.load_count = df_processed.load_count.cumsum()
+    with span('(ii)', 'rule', df_processed, ['load']):
+        df_processed.loc[(
+            (
+                (df_processed.energy.diff() > energy_threshold)
+                | (df_processed.power > min_active_load * power_capacity))
+            & (df_processed.meter_number == df_processed.meter_number.shift())
+        ), 'load'] = df_processed.energy.diff()
+
+    # (iii): Create a column 'load_count' for accumulated numbering of when a load is applied OR new meter_number,
+    # so that 'timestamp_load' never refers to a load instance of another meter.
+    with span('(iii)', 'rule', df_processed, ['load_count']):
+        df_processed['load_count'] = 0  # start
+        df_processed.loc[((df_processed.load.isnull() == False)
+                          | (df_processed.meter_number != df_processed.meter_number.shift())), 'load_count'] += 1
+        df_processed.load_count = df_processed.load_count.cumsum()
 
     # (iv): Create a column 'timestamp_load' for a timestamp of each load instance
-    load_instance = df_processed.groupby('load_count').first()
-    load_instance.reset_index(inplace=True)
-    df_processed['timestamp_load'] = df_processed.load_count.map(
-        load_instance.set_index('load_count')['timestamp'].to_dict())
+    with span('(iv)', 'rule', df_processed, ['timestamp_load']):
+        df_processed['timestamp_load'] = group_first(df_processed.load_count, df_processed.timestamp)
 
     # (v): Cooking_start = TRUE: if timestamp_load - current timestamp is more than t_between and above energy_threshold OR new meter_number
-    df_processed.loc[
-        (
+    with span('(v)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
             (
-                (df_processed.timestamp -
-                 df_processed.timestamp_load.shift() > pd.to_timedelta(
-                     t_between,
-                     unit='m'))
-                & (df_processed.energy.diff() >= energy_threshold))
-            | (
-                df_processed.meter_number != df_processed.meter_number.shift())
-        ), 'cooking_start'] = True
+                (
+                    (df_processed.timestamp -
+                     df_processed.timestamp_load.shift() > pd.to_timedelta(
+                         t_between,
+                         unit='m'))
+                    & (df_processed.energy.diff() >= energy_threshold))
+                | (
+                    df_processed.meter_number != df_processed.meter_number.shift())
+            ), 'cooking_start'] = True
 
     # (vi): Cooking_start = FALSE: if energy increase is above energy threshold and diff_prev_timestamp is less than t_between
-    df_processed.loc[
-        (
-            (df_processed.energy.diff() >= energy_threshold)
-            & (df_processed.diff_prev_timestamp < pd.to_timedelta(t_between, unit='m'))
-        ), 'cooking_start'] = False
+    with span('(vi)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.energy.diff() >= energy_threshold)
+                & (df_processed.diff_prev_timestamp < pd.to_timedelta(t_between, unit='m'))
+            ), 'cooking_start'] = False
 
     # (vii): Cooking_start = TRUE: if previous to current timestamp_load difference is above t_between + time_resolution AND power level is above 'power threshold', i.e. min_active_load * power_capacity
-    df_processed.loc[
-        (
-            (df_processed.timestamp_load.diff() > pd.to_timedelta(t_between + time_resolution, unit='m'))
-            & (df_processed.power >= power_threshold)
-        ), 'cooking_start'] = True
+    with span('(vii)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.timestamp_load.diff() > pd.to_timedelta(t_between + time_resolution, unit='m'))
+                & (df_processed.power >= power_threshold)
+            ), 'cooking_start'] = True
 
     # (viii): Cooking_end = TRUE: if difference between current timestamp and timestamp_load is above t_between AND power is above threshold on current and previous row AND same meter_number are all TRUE.
-    df_processed.loc[
-        (
-            (df_processed.timestamp - df_processed.timestamp_load > pd.to_timedelta(
-                t_between, unit='m'))
-            & ((df_processed.power < power_threshold)
-               & (df_processed.power.shift() < power_threshold)
-               & (df_processed.meter_number == df_processed.meter_number.shift())
-               )
-            | (df_processed.energy - df_processed.energy.shift(-1) == 0)
-        ), 'cooking_end'] = True
+    with span('(viii)', 'rule', df_processed, ['cooking_end']):
+        df_processed.loc[
+            (
+                (df_processed.timestamp - df_processed.timestamp_load > pd.to_timedelta(
+                    t_between, unit='m'))
+                & ((df_processed.power < power_threshold)
+                   & (df_processed.power.shift() < power_threshold)
+                   & (df_processed.meter_number == df_processed.meter_number.shift())
+                   )
+                | (df_processed.energy - df_processed.energy.shift(-1) == 0)
+            ), 'cooking_end'] = True
 
     # (ix): Cooking_start = TRUE: if difference between current timestamp and timestamp_load is above t_between AND power above power_threshold
-    df_processed.loc[
-        (
-            (df_processed.timestamp - df_processed.timestamp_load > pd.to_timedelta(
-                t_between, unit='m'))
-            & (df_processed.power >= power_threshold)
-        ), 'cooking_start'] = True
-
-    # (x): Cooking_end = TRUE: if cooking_start in next row is TRUE OR new meter_number
-    df_processed.loc[
-        (
-            (df_processed.cooking_start.shift(-1))
-            | (df_processed.meter_number != df_processed.meter_number.shift(-1))
-        ), 'cooking_end'] = True
+    with span('(ix)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.timestamp - df_processed.timestamp_load > pd.to_timedelta(
+                    t_between, unit='m'))
+                & (df_processed.power >= power_threshold)
+            ), 'cooking_start'] = True
+
+    # (x): Cooking_end = TRUE: if cooking_start in next row is TRUE OR new meter_number (incl. the last row)
+    with span('(x)', 'rule', df_processed, ['cooking_end']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_start.shift(-1, fill_value=False))
+                | (df_processed.meter_number != df_processed.meter_number.shift(-1))
+            ), 'cooking_end'] = True
 
     # (xi): Cooking_end = TRUE: if cooking_end in next row is TRUE AND diff_next_timestamp is above t_between
-    df_processed.loc[
-        (
-            (df_processed.cooking_end.shift(-1))
-            & (df_processed.diff_next_timestamp > pd.to_timedelta(t_between, unit='m'))
-        ), 'cooking_end'] = True
+    with span('(xi)', 'rule', df_processed, ['cooking_end']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_end.shift(-1))
+                & (df_processed.diff_next_timestamp > pd.to_timedelta(t_between, unit='m'))
+            ), 'cooking_end'] = True
 
     # (xii): Cooking_start = TRUE: if cooking_end on prev row AND cooking_end on current row
-    df_processed.loc[
-        (
-            (df_processed.cooking_end.shift())
-            & (df_processed.cooking_end)
-        ), 'cooking_start'] = True
+    with span('(xii)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_end.shift())
+                & (df_processed.cooking_end)
+            ), 'cooking_start'] = True
 
     # (xiii): Cooking_start = FALSE: if cooking_start on prev row AND cooking_start = TRUE in current row AND diff_prev_timestamp is less than t_between AND diff_next_timestamp is more than t_between.
-    df_processed.loc[
-        (
-            (df_processed.cooking_start.shift())
-            & (df_processed.cooking_start)
-            & (df_processed.diff_prev_timestamp <= pd.to_timedelta(
-                t_between, unit='m'))
-            & (df_processed.diff_next_timestamp > pd.to_timedelta(
-                t_between, unit='m'))
-        ), 'cooking_start'] = False
+    with span('(xiii)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_start.shift())
+                & (df_processed.cooking_start)
+                & (df_processed.diff_prev_timestamp <= pd.to_timedelta(
+                    t_between, unit='m'))
+                & (df_processed.diff_next_timestamp > pd.to_timedelta(
+                    t_between, unit='m'))
+            ), 'cooking_start'] = False
 
     # (xiv): Cooking_end = FALSE: if cooking_end on prev row AND cooking_end in current row == TRUE AND diff_prev_timestamp is more than t_between AND diff_next_timestamp is less than t_between.
-    df_processed.loc[
-        (
-            (df_processed.cooking_end.shift())
-            & (df_processed.cooking_end)
-            & (df_processed.diff_prev_timestamp > pd.to_timedelta(t_between, unit='m'))
-            & (df_processed.diff_next_timestamp <= pd.to_timedelta(t_between, unit='m'))
-        ), 'cooking_end'] = False
+    with span('(xiv)', 'rule', df_processed, ['cooking_end']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_end.shift())
+                & (df_processed.cooking_end)
+                & (df_processed.diff_prev_timestamp > pd.to_timedelta(t_between, unit='m'))
+                & (df_processed.diff_next_timestamp <= pd.to_timedelta(t_between, unit='m'))
+            ), 'cooking_end'] = False
 
     # (xv): Cooking_start = FALSE: if cooking_start in prev row = TRUE AND cooking_start in current row = TRUE AND diff_prev_timestamp is less than t_between AND prev row has power above threshold.
-    df_processed.loc[
-        (
-            (df_processed.cooking_start.shift())
-            & (df_processed.cooking_start)
-            & (df_processed.diff_prev_timestamp < pd.to_timedelta(
-                t_between, unit='m'))
-            & (df_processed.power.shift() >= power_threshold)
-        ), 'cooking_start'] = False
+    with span('(xv)', 'rule', df_processed, ['cooking_start']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_start.shift())
+                & (df_processed.cooking_start)
+                & (df_processed.diff_prev_timestamp < pd.to_timedelta(
+                    t_between, unit='m'))
+                & (df_processed.power.shift() >= power_threshold)
+            ), 'cooking_start'] = False
 
     # (xvi):
-    df_processed.loc[
-        (
-            (df_processed.cooking_end.shift(-1) == 0)
-            & (df_processed.cooking_end.shift() == 0)
-            & (df_processed.diff_next_timestamp > pd.to_timedelta(
-                t_between, unit='m'))
-        ), 'cooking_end'] = True
+    with span('(xvi)', 'rule', df_processed, ['cooking_end']):
+        df_processed.loc[
+            (
+                (df_processed.cooking_end.shift(-1) == 0)
+                & (df_processed.cooking_end.shift() == 0)
+                & (df_processed.diff_next_timestamp > pd.to_timedelta(
+                    t_between, unit='m'))
+            ), 'cooking_end'] = True
 
     # (xvii): if new meter number Cooking_start = TRUE, Cooking_end = FALSE
-    df_processed.loc[
-        (df_processed.meter_number.diff() != 0), 'cooking_start'] = True
+    with span('(xvii)', 'rule', df_processed, ['cooking_start', 'cooking_end']):
+        df_processed.loc[
+            (df_processed.meter_number.diff() != 0), 'cooking_start'] = True
+
+        df_processed.loc[
+            (df_processed.meter_number.diff() != 0), 'cooking_end'] = False
+
+    return df_processed
 
-    df_processed.loc[
-        (df_processed.meter_number.diff() != 0), 'cooking_end'] = False
 
+def conditions_kernel(meter, timestamp, energy, power, load, diff_prev, diff_prev_ok, diff_next,
+                      diff_next_ok, energy_threshold, power_threshold, t_between, t_between_resolution):
+    # The rules (ii) to (xvii) of event_conditions on contiguous arrays: meter_number as float (so
+    # that NaN is a new meter), timestamp and diff_*_timestamp as int64 nanoseconds (NaT where
+    # diff_*_ok is False), energy, power and an already existing 'load' column as float.
+    n = len(meter)
+    same_prev = np.zeros(n, dtype=np.bool_)
+    same_prev[1:] = meter[1:] == meter[:-1]
+    same_next = np.zeros(n, dtype=np.bool_)
+    same_next[:-1] = meter[:-1] == meter[1:]
+    energy_diff = np.full(n, np.nan)
+    energy_diff[1:] = energy[1:] - energy[:-1]
+    power_prev = np.full(n, np.nan)
+    power_prev[1:] = power[:-1]
+
+    # (ii): 'load' when a load is applied
+    is_load = ((energy_diff > energy_threshold) | (power > power_threshold)) & same_prev
+    load = load.copy()
+    load[is_load] = energy_diff[is_load]
+    is_load = ~np.isnan(load)
+
+    # (iii) & (iv): 'load_count' and 'timestamp_load' of each load instance, restarting at a new meter_number
+    new_group = is_load | ~same_prev
+    load_count = np.cumsum(new_group.astype(np.int64))
+    timestamp_load = timestamp[np.nonzero(new_group)[0][load_count - 1]]
+    since_load = timestamp - timestamp_load
+    since_load_prev = np.zeros(n, dtype=np.bool_)
+    since_load_prev[1:] = timestamp[1:] - timestamp_load[:-1] > t_between
+    load_diff = np.zeros(n, dtype=np.bool_)
+    load_diff[1:] = timestamp_load[1:] - timestamp_load[:-1] > t_between_resolution
+
+    prev_below_t = diff_prev_ok & (diff_prev < t_between)
+    prev_within_t = diff_prev_ok & (diff_prev <= t_between)
+    prev_above_t = diff_prev_ok & (diff_prev > t_between)
+    next_within_t = diff_next_ok & (diff_next <= t_between)
+    next_above_t = diff_next_ok & (diff_next > t_between)
+
+    cooking_start = np.zeros(n, dtype=np.bool_)
+    cooking_end = np.zeros(n, dtype=np.bool_)
+    # (v)
+    cooking_start[(since_load_prev & (energy_diff >= energy_threshold)) | ~same_prev] = True
+    # (vi)
+    cooking_start[(energy_diff >= energy_threshold) & prev_below_t] = False
+    # (vii)
+    cooking_start[load_diff & (power >= power_threshold)] = True
+    # (viii)
+    energy_next_equal = np.zeros(n, dtype=np.bool_)
+    energy_next_equal[:-1] = energy[:-1] - energy[1:] == 0
+    cooking_end[((since_load > t_between) & (power < power_threshold) & (power_prev < power_threshold)
+                 & same_prev) | energy_next_equal] = True
+    # (ix)
+    cooking_start[(since_load > t_between) & (power >= power_threshold)] = True
+    # (x)
+    start_next = np.zeros(n, dtype=np.bool_)
+    start_next[:-1] = cooking_start[1:]
+    cooking_end[start_next | ~same_next] = True
+    # (xi)
+    end_next = np.zeros(n, dtype=np.bool_)
+    end_next[:-1] = cooking_end[1:]
+    cooking_end[end_next & next_above_t] = True
+    # (xii)
+    end_prev = np.zeros(n, dtype=np.bool_)
+    end_prev[1:] = cooking_end[:-1]
+    cooking_start[end_prev & cooking_end] = True
+    # (xiii)
+    start_prev = np.zeros(n, dtype=np.bool_)
+    start_prev[1:] = cooking_start[:-1]
+    cooking_start[start_prev & cooking_start & prev_within_t & next_above_t] = False
+    # (xiv)
+    end_prev[1:] = cooking_end[:-1]
+    cooking_end[end_prev & cooking_end & prev_above_t & next_within_t] = False
+    # (xv)
+    start_prev[1:] = cooking_start[:-1]
+    cooking_start[start_prev & cooking_start & prev_below_t & (power_prev >= power_threshold)] = False
+    # (xvi)
+    no_end_next = np.zeros(n, dtype=np.bool_)
+    no_end_next[:-1] = ~cooking_end[1:]
+    no_end_prev = np.zeros(n, dtype=np.bool_)
+    no_end_prev[1:] = ~cooking_end[:-1]
+    cooking_end[no_end_next & no_end_prev & next_above_t] = True
+    # (xvii)
+    cooking_start[~same_prev] = True
+    cooking_end[~same_prev] = False
+    return load, load_count, timestamp_load, cooking_start, cooking_end
+
+
+if njit is not None:
+    conditions_kernel = njit(cache=True)(conditions_kernel)
+
+
+@traced('event_conditions_numpy')
+def event_conditions_numpy(df_processed,
+                           min_active_load=0.15,
+                           power_capacity=1,
+                           time_resolution=5,
+                           t_between=15):
+    # Same rules and output columns as event_conditions, with conditions_kernel on NumPy arrays
+    # (compiled by numba where available) instead of a boolean Series for every rule.
+    power_threshold = min_active_load * power_capacity
+    energy_threshold = power_threshold * time_resolution / 60
+
+    diff_prev = pd.to_timedelta(df_processed.diff_prev_timestamp).to_numpy(dtype='timedelta64[ns]')
+    diff_next = pd.to_timedelta(df_processed.diff_next_timestamp).to_numpy(dtype='timedelta64[ns]')
+    if 'load' in df_processed.columns:
+        load = df_processed.load.to_numpy(dtype=float)
+    else:
+        load = np.full(len(df_processed), np.nan)
+
+    load, load_count, timestamp_load, cooking_start, cooking_end = conditions_kernel(
+        df_processed.meter_number.to_numpy(dtype=float),
+        df_processed.timestamp.to_numpy(dtype='datetime64[ns]').view(np.int64),
+        df_processed.energy.to_numpy(dtype=float),
+        df_processed.power.to_numpy(dtype=float),
+        load,
+        diff_prev.view(np.int64), ~np.isnat(diff_prev),
+        diff_next.view(np.int64), ~np.isnat(diff_next),
+        energy_threshold, power_threshold,
+        pd.Timedelta(minutes=t_between).value,
+        pd.Timedelta(minutes=t_between + time_resolution).value)
+
+    df_processed['load'] = load
+    df_processed['load_count'] = load_count
+    df_processed['timestamp_load'] = timestamp_load.view('datetime64[ns]')
+    df_processed['cooking_start'] = cooking_start
+    df_processed['cooking_end'] = cooking_end
     return df_processed
 
 
-def timestamp_issue(df_processed, error_margin=0.04):
-    df_epc = df_processed.copy()
+@traced('timestamp_issue')
+@cached('timestamp_issue')
+def timestamp_issue(df_processed, error_margin=0.04, copy=True):
+    df_epc = df_processed.copy() if copy else df_processed
+
+    # The first and last row of each cooking event, in the order of the rows, see event_groups
+    rows, starts = event_groups(df_epc.meter_number, df_epc.cooking_event)
+    first = np.sort(rows[starts])
+    last = np.sort(rows[(np.append(starts[1:], len(rows)) - 1)[:len(starts)]])
+    energy = df_epc.energy.to_numpy()
+    meter_number = df_epc.meter_number.to_numpy()
+    cooking_event = df_epc.cooking_event
 
     # checking start of events
-    start_of_event = df_epc.copy()
-    start_of_event = start_of_event.groupby(
-        ['meter_number', 'cooking_event']).head(1)
-    start_of_event.loc[
-        ((start_of_event['energy'] -
-          error_margin <= start_of_event['energy'].shift()) & (
-            start_of_event.cooking_event.isnull() == False) & (
-            start_of_event.meter_number == start_of_event.meter_number.shift())),
-        'timestamp_issue'] = True
-
-    df_epc['timestamp_issue'] = df_epc.cooking_event.map(
-        start_of_event.set_index('cooking_event')['timestamp_issue'].to_dict())
+    issue = np.zeros(len(first), dtype=bool)
+    issue[1:] = (energy[first][1:] - error_margin <= energy[first][:-1]) & (
+        meter_number[first][1:] == meter_number[first][:-1])
+    start_issue = np.full(len(first), np.nan, dtype=object)
+    start_issue[issue] = True
+    df_epc['timestamp_issue'] = lookup(
+        cooking_event, cooking_event.iloc[first], pd.Series(start_issue))
 
     # checking end of events
-    end_of_event = df_epc.copy()
-    end_of_event = end_of_event.groupby(
-        ['meter_number', 'cooking_event']).tail(1)
-    end_of_event.loc[
-        ((end_of_event['energy'] -
-          error_margin <= end_of_event['energy'].shift()) & (
-            end_of_event.cooking_event.isnull() == False) & (
-            end_of_event.meter_number == end_of_event.meter_number.shift())),
-        'timestamp_issue'] = True
-
-    df_epc['timestamp_issue'] = df_epc.cooking_event.map(
-        end_of_event.set_index('cooking_event')['timestamp_issue'].to_dict())
-    df_epc.drop(df_epc[(df_epc['timestamp_issue'] == 1)].index, inplace=True)
+    issue = np.zeros(len(last), dtype=bool)
+    issue[1:] = (energy[last][1:] - error_margin <= energy[last][:-1]) & (
+        meter_number[last][1:] == meter_number[last][:-1])
+    end_issue = df_epc['timestamp_issue'].to_numpy()[last]
+    end_issue[issue] = True
+    df_epc['timestamp_issue'] = lookup(
+        cooking_event, cooking_event.iloc[last], pd.Series(end_issue))
+    # drop the recordings of the duplicates, only for the meter_number where they appear. The
+    # (meter_number, timestamp) pairs are only compared for the rows with a duplicated timestamp.
+    issue = (df_epc['timestamp_issue'] == 1).to_numpy()
+    candidates = np.flatnonzero(df_epc.index.isin(df_epc.index[issue]))
+    meter_timestamp = pd.MultiIndex.from_arrays([meter_number[candidates], df_epc.index[candidates]])
+    drop = candidates[meter_timestamp.isin(pd.MultiIndex.from_arrays([meter_number[issue], df_epc.index[issue]]))]
+    df_epc = take_rows(df_epc, np.setdiff1d(np.arange(len(df_epc)), drop))
     return df_epc
 
 
+@traced('only_events')
+@cached('only_events')
 def only_events(
         df_epc,
         TZS_per_kWh=100):
-    df_only_events = df_epc.copy()
-    df_only_events.reset_index(inplace=True)
-    df_only_events['energy_gen'] = df_only_events.energy
-
-    df_only_events = df_only_events.groupby(['meter_number',
-                                             'cooking_event']).agg({'energy': 'max',
-                                                                    'energy_gen': 'min',
-                                                                    'power': 'mean',
-                                                                    'cooking_time': 'max',
-                                                                    'timestamp': 'min',
-                                                                    'current': 'mean',
-                                                                    'voltage': 'count',
-                                                                    'id': 'mean'})
-
-    # (a): counting number of recordings in each cooking event
-    df_only_events.rename(
-        columns={
-            'voltage': 'no_recordings'},
-        inplace=True)
+    # (1) Why not groupby(['meter_number', 'cooking_event']).agg?: The cooking events are grouped
+    # once by integer groups (event_groups), and the columns are reduced from their rows without
+    # copying them into a frame first.
+    # (2) As by the former agg: 'energy' max, 'energy_gen' min (of 'energy'), 'power' mean,
+    # 'cooking_time' max, 'timestamp' min, 'current' mean, 'voltage' count and 'id' mean.
+    rows, starts = event_groups(df_epc.meter_number, df_epc.cooking_event)
+    timestamp = df_epc.timestamp if 'timestamp' in df_epc.columns else df_epc.index
+
+    def values(column):
+        # float32 columns (as of compact_schema) stay float32, as by groupby
+        dtype = np.float32 if df_epc[column].dtype == np.float32 else float
+        return df_epc[column].to_numpy(dtype=dtype, na_value=np.nan)[rows]
+
+    def mean(column):
+        total, number = event_sum(values(column), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / number.astype(total.dtype)
+
+    energy = values('energy')
+    df_only_events = pd.DataFrame({
+        'meter_number': df_epc.meter_number.to_numpy()[rows[starts]],
+        'cooking_event': df_epc.cooking_event.array[rows[starts]],
+        'energy': event_reduce(np.fmax, energy, starts),
+        'energy_gen': event_reduce(np.fmin, energy, starts),
+        'power': mean('power'),
+        'cooking_time': event_reduce(np.fmax, values('cooking_time'), starts),
+        'timestamp': event_reduce(np.minimum, np.asarray(timestamp, dtype='datetime64[ns]')[rows], starts),
+        'current': mean('current'),
+        # (a): counting number of recordings in each cooking event
+        'no_recordings': event_reduce(np.add, df_epc.voltage.notnull().to_numpy()[rows].astype(np.int64), starts),
+        'id': mean('id')})
 
     # (b): calculating the energy usage of each cooking event
     df_only_events.energy_gen = df_only_events.energy - df_only_events.energy_gen
@@ -341,49 +880,80 @@ def only_events(
     # (e): calculating the cost of cooking (Tanzanian Shilling)
     df_only_events['cooking_cost'] = df_only_events.energy_gen * TZS_per_kWh
 
-    df_only_events.reset_index(inplace=True)
-    df_only_events['event_count'] = 0
-    df_only_events.loc[(df_only_events.cooking_event.diff()
-                        != 0), 'event_count'] += 1
-    df_only_events.event_count = df_only_events['event_count'].cumsum()
+    # (f): counting the cooking events, on NumPy so that a nullable cooking_event (as of compact_schema)
+    # starts at 1 as well
+    cooking_event = df_only_events.cooking_event.to_numpy(dtype=float, na_value=np.nan)
+    df_only_events['event_count'] = np.cumsum(np.diff(cooking_event, prepend=np.nan) != 0)
 
     df_only_events.set_index('timestamp', inplace=True)
     return df_only_events
 
 
+@traced('period')
 def period(df, start='2020-03-09', end='2020-11-15'):
     if 'timestamp' in df.columns:
-        df.timestamp = pd.to_datetime(df.timestamp)
-        df.timestamp = np.int64(df.timestamp)
-        df.timestamp = pd.to_datetime(df.timestamp)
+        df.timestamp = parse_timestamps(df.timestamp)
         df.set_index('timestamp', inplace=True)
-    df_period = df.copy()
-    df_period.drop(df_period[(((df_period.index < pd.to_datetime(
-        str(start) + ' 00:00:00'))))].index, inplace=True)
-    df_period.drop(df_period[(((df_period.index >= pd.to_datetime(
-        str(end) + ' 00:00:00'))))].index, inplace=True)
+    df_period = df.take(np.flatnonzero(
+        (df.index >= pd.to_datetime(str(start) + ' 00:00:00'))
+        & (df.index < pd.to_datetime(str(end) + ' 00:00:00'))))
     return df_period
 
-def addtoevent_ending(df_epc, 
-                      power_capacity=1,
-                     time_resolution=5):
-
-    if 'timestamp' in df_epc.columns:
-        print('timestamp is not in index')
-    else:
-        df_epc.reset_index(inplace=True)
-
-    df_epc.loc[
-        (
-            (df_epc.cooking_event.isnull() == False)
-            & (df_epc.cooking_event != df_epc.cooking_event.shift(-1))
-            & (df_epc.meter_number == df_epc.meter_number.shift(-1))
-        ), 'energy_gap_to_next'] = df_epc.energy.shift(-1) - df_epc.energy
-
-    df_epc_energy_gaps = df_epc.copy()
-    df_epc_energy_gaps = df_epc_energy_gaps.loc[df_epc['energy_gap_to_next'] > 0]
-
-    df_epc_energy_gaps['energy_gap_time'] = df_epc.energy_gap_to_next / \
+def take_rows(df, positions):
+    # df.take(positions), column by column. DataFrame.take first consolidates the columns of each
+    # dtype into one block, which copies all columns that were added one by one, so that the copy of
+    # the whole frame was held twice at that moment.
+    df_taken = pd.DataFrame(index=df.index[positions])
+    for column in df.columns:
+        df_taken[column] = df[column].array.take(positions)
+    return df_taken
+
+
+def sort_keys(df):
+    # (meter_number, timestamp) of each row as one structured array, which NumPy sorts and searches
+    # by meter_number first and timestamp second
+    keys = np.empty(len(df), dtype=[('meter_number', np.float64), ('timestamp', np.int64)])
+    keys['meter_number'] = df.meter_number.to_numpy(dtype=np.float64)
+    keys['timestamp'] = df.timestamp.values.astype('datetime64[ns]').view(np.int64)
+    return keys
+
+
+def is_sorted(keys):
+    meter_number, timestamp = keys['meter_number'], keys['timestamp']
+    return bool(np.all((meter_number[1:] > meter_number[:-1])
+                       | ((meter_number[1:] == meter_number[:-1]) & (timestamp[1:] >= timestamp[:-1]))))
+
+
+def merge_order(keys, rows_keys):
+    # The order of the rows of a frame (sorted by keys) followed by rows (rows_keys) as by a stable
+    # sort, i.e. the added rows go after the rows with equal keys. Only the added rows are sorted,
+    # their positions in the frame are found by binary search.
+    rows_order = np.argsort(rows_keys, kind='stable')
+    added = np.searchsorted(keys, rows_keys[rows_order], side='right') + np.arange(len(rows_keys))
+    order = np.empty(len(keys) + len(rows_keys), dtype=np.int64)
+    is_added = np.zeros(len(order), dtype=bool)
+    is_added[added] = True
+    order[added] = len(keys) + rows_order
+    order[~is_added] = np.arange(len(keys))
+    return order
+
+
+def merge_rows(frames, order):
+    # The rows of frames (one after the other) in the given order, column by column (see take_rows).
+    # Columns of the first frame that are not in the others are NaN there.
+    df_merged = pd.DataFrame(index=pd.RangeIndex(len(order)))
+    for column in frames[0].columns:
+        df_merged[column] = pd.concat(
+            [df[column] if column in df.columns else pd.Series(np.nan, index=df.index) for df in frames],
+            ignore_index=True).array.take(order)
+    return df_merged
+
+
+def extend_ending(df_epc_energy_gaps,
+                  power_capacity=1,
+                  time_resolution=5):
+
+    df_epc_energy_gaps['energy_gap_time'] = df_epc_energy_gaps.energy_gap_to_next / \
         power_capacity * 60
     df_epc_energy_gaps['energy_gap_time_datetime'] = df_epc_energy_gaps['energy_gap_time'] * \
         60 * np.timedelta64(1, 's')
@@ -422,40 +992,14 @@ def addtoevent_ending(df_epc,
     df_epc_energy_gaps.loc[energy_gap_above_5_min, 'energy_end'] -= time_resolution / 60
 
     df_epc_energy_gaps = df_epc_energy_gaps.drop(['energy_gap_time', 'energy_gap_time_datetime', 'energy_gap_to_next'], axis=1)
-    df_epc = df_epc.append(df_epc_energy_gaps)
-    
-    df_epc['time_end'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['time_end'].to_dict())
-    df_epc['cooking_time'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['cooking_time'].to_dict())
-    df_epc['energy_end'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['energy_end'].to_dict())
-    df_epc.sort_values(by=['meter_number', 'timestamp'],
-                       ascending=[True, True], inplace=True)
-    df_epc.set_index('timestamp', inplace=True)
-    return df_epc
+    return df_epc_energy_gaps
 
 
-def addtoevent_beginning(df_epc, 
-                      power_capacity=1,
+def extend_beginning(df_epc_energy_gaps,
+                     power_capacity=1,
                      time_resolution=5):
 
-    if 'timestamp' in df_epc.columns:
-        print('timestamp is not in index')
-    else:
-        df_epc.reset_index(inplace=True)
-
-    df_epc.loc[
-        (
-            (df_epc.cooking_event.isnull() == False)
-            & (df_epc.cooking_event != df_epc.cooking_event.shift())
-            & (df_epc.meter_number == df_epc.meter_number.shift())
-        ), 'energy_gap_to_prev'] = df_epc.energy.diff()
-
-    df_epc_energy_gaps = df_epc.copy()
-    df_epc_energy_gaps = df_epc_energy_gaps.loc[df_epc['energy_gap_to_prev'] > 0]
-
-    df_epc_energy_gaps['energy_gap_time'] = df_epc.energy_gap_to_prev / \
+    df_epc_energy_gaps['energy_gap_time'] = df_epc_energy_gaps.energy_gap_to_prev / \
         power_capacity * 60
     df_epc_energy_gaps['energy_gap_time_datetime'] = df_epc_energy_gaps['energy_gap_time'] * \
         60 * np.timedelta64(1, 's')
@@ -494,31 +1038,833 @@ def addtoevent_beginning(df_epc,
     df_epc_energy_gaps.loc[energy_gap_above_5_min, 'energy_start'] -= 5 / 60
 
     df_epc_energy_gaps = df_epc_energy_gaps.drop(['energy_gap_time', 'energy_gap_time_datetime', 'energy_gap_to_prev'], axis=1)
-    df_epc = df_epc.append(df_epc_energy_gaps)
+    return df_epc_energy_gaps
+
+
+@traced('addtoevent')
+@cached('addtoevent')
+def addtoevent(df_epc,
+               power_capacity=1,
+               time_resolution=5):
+    # (1) What?: Extend the cooking events with an energy gap to the next recording by a row after
+    # their last row (extend_ending), and then the cooking events with an energy gap to the previous
+    # recording by a row before their first row (extend_beginning).
+    # (2) Why not append and sort?: The recordings are sorted by meter_number and timestamp already
+    # and the added rows are few. The added rows are sorted on their own and merged into the
+    # recordings by binary search (merge_order), as by a stable sort, i.e. after recordings with the
+    # same timestamp, and the frame is copied once with all rows (merge_rows). Recordings that are
+    # not sorted are sorted with the rows at the ending, once.
+
+    if 'timestamp' not in df_epc.columns:
+        df_epc.reset_index(inplace=True)
 
-    df_epc['time_start'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['time_start'].to_dict())
-    df_epc['cooking_time'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['cooking_time'].to_dict())
-    df_epc['energy_start'] = df_epc.cooking_event.map(
-        df_epc_energy_gaps.set_index('cooking_event')['energy_start'].to_dict())
+    # (a): ending
+    # the last row of each cooking event, on NumPy as (b), so that a nullable cooking_event (as of
+    # compact_schema) is compared as NaN, not NA
+    cooking_event = df_epc.cooking_event.to_numpy(dtype=float, na_value=np.nan)
+    meter_number = df_epc.meter_number.to_numpy()
+    last = np.zeros(len(df_epc), dtype=bool)
+    last[:-1] = ~np.isnan(cooking_event[:-1]) & (cooking_event[:-1] != cooking_event[1:]) & (
+        meter_number[:-1] == meter_number[1:])
+    df_epc.loc[last, 'energy_gap_to_next'] = df_epc.energy.shift(-1) - df_epc.energy
+
+    df_epc_energy_gaps = extend_ending(
+        take_rows(df_epc, np.flatnonzero(df_epc['energy_gap_to_next'] > 0)), power_capacity, time_resolution)
+    # the added rows don't start a cooking event, so that 'cooking_start' still counts the cooking
+    # events (see refine_events)
+    df_epc_energy_gaps['cooking_start'] = False
+
+    # The rows of the extended cooking events get the updated columns, before the rows are added
+    # (i.e. to the frame that is not copied yet)
+    for column in ['time_end', 'cooking_time', 'energy_end']:
+        values = df_epc_energy_gaps[column].copy()
+        df_epc[column] = lookup(df_epc.cooking_event, df_epc_energy_gaps.cooking_event, values)
+        df_epc_energy_gaps[column] = lookup(
+            df_epc_energy_gaps.cooking_event, df_epc_energy_gaps.cooking_event, values)
+
+    # (b): beginning, in the recordings with the rows at the ending (df_epc_ending) in their order
+    # (order_ending), without building that frame
+    df_epc_ending = df_epc_energy_gaps
+    n = len(df_epc) + len(df_epc_ending)
+    keys = np.concatenate([sort_keys(df_epc), sort_keys(df_epc_ending)])
+    if is_sorted(keys[:len(df_epc)]):
+        order_ending = merge_order(keys[:len(df_epc)], keys[len(df_epc):])
+    else:
+        order_ending = np.argsort(keys, kind='stable')
+    keys = keys[order_ending]
+
+    def merged(column):
+        return np.concatenate([df[column].to_numpy(dtype=float, na_value=np.nan) if column in df.columns else np.full(len(df), np.nan)
+                               for df in (df_epc, df_epc_ending)])[order_ending]
+
+    cooking_event, meter_number, energy = merged('cooking_event'), merged('meter_number'), merged('energy')
+    energy_gap_to_prev = merged('energy_gap_to_prev')
+    first = np.flatnonzero(~np.isnan(cooking_event[1:]) & (cooking_event[1:] != cooking_event[:-1])
+                           & (meter_number[1:] == meter_number[:-1])) + 1
+    energy_gap_to_prev[first] = energy[first] - energy[first - 1]
+    values = np.empty(n)
+    values[order_ending] = energy_gap_to_prev
+    df_epc['energy_gap_to_prev'] = values[:len(df_epc)]
+    df_epc_ending['energy_gap_to_prev'] = values[len(df_epc):]
+
+    gaps = np.flatnonzero(energy_gap_to_prev > 0)
+    df_epc_energy_gaps = extend_beginning(
+        merge_rows([df_epc, df_epc_ending], order_ending[gaps]), power_capacity, time_resolution)
+    # the added row starts the cooking event instead of the row it was copied from
+    copied = order_ending[gaps]
+    for df, rows in ((df_epc, copied[copied < len(df_epc)]),
+                     (df_epc_ending, copied[copied >= len(df_epc)] - len(df_epc))):
+        df.iloc[rows, df.columns.get_loc('cooking_start')] = False
+
+    for column in ['time_start', 'cooking_time', 'energy_start']:
+        values = df_epc_energy_gaps[column].copy()
+        for df in (df_epc, df_epc_ending, df_epc_energy_gaps):
+            df[column] = lookup(df.cooking_event, df_epc_energy_gaps.cooking_event, values)
+
+    # (c): all rows, copied once
+    order = merge_order(keys, sort_keys(df_epc_energy_gaps))
+    order = np.where(order < n, order_ending[np.minimum(order, n - 1)], order)
+    df_epc = merge_rows([df_epc, df_epc_ending, df_epc_energy_gaps], order)
 
-    df_epc.sort_values(by=['meter_number', 'timestamp'],
-                       ascending=[True, True], inplace=True)
     df_epc.set_index('timestamp', inplace=True)
     return df_epc
 
 
-# Source file
-df_raw = pd.read_csv('dataframe_raw.csv', sep=',')
+@traced('refine_events')
+@cached('refine_events')
+def refine_events(df_epc,
+                  min_cooking_event=0.05,
+                  power_mean_min=0.05,
+                  copy=True):
+    # (1) What?: The second pass of cooking_event for cooking events that are already numbered, after
+    # timestamp_issue and addtoevent only moved their first or last row. Only 'time_start',
+    # 'time_end', 'energy_start', 'energy_end', 'cooking_time' and 'seq_time' are updated, and the
+    # cooking events are disqualified again (min_cooking_event, power_mean_min) only where these
+    # changed.
+    # (2) Why?: The second cooking_event evaluates all event conditions again, on more rows than the
+    # first one. Here the cooking events are not defined again, so that the rows added at the end
+    # stay in their cooking event, where the second cooking_event mostly starts a new (too short)
+    # cooking event.
+    df_epc = df_epc.copy() if copy else df_epc
+    if 'timestamp' not in df_epc.columns:
+        df_epc.reset_index(inplace=True)
+
+    # (a): rows between rows of the same cooking event belong to it, e.g. a row that was not part
+    # of a cooking event before a row added at its beginning
+    between = (df_epc.cooking_event.isnull()
+               & (df_epc.cooking_event.ffill() == df_epc.cooking_event.bfill()))
+    df_epc.loc[between, 'cooking_event'] = df_epc.cooking_event.ffill()[between]
+
+    # The cooking events keep their numbers and 'cooking_start' that of the first cooking_event (which
+    # addtoevent moves to the rows added at the beginning), so that renumber_meter and update_meter
+    # count the cooking events of the first cooking_event, as numbered in a serial run
+
+    # (b): the columns of each cooking event from its first and last row, which are changed where
+    # rows were added (or the first or last row dropped). addtoevent sets the columns of the
+    # extended cooking events already, but not 'seq_time' (and not as from their rows).
+    columns = {
+        'time_start': group_first(df_epc.cooking_event, df_epc.timestamp),
+        'energy_start': group_first(df_epc.cooking_event, df_epc.energy),
+        'time_end': group_first(df_epc.cooking_event, df_epc.timestamp, last=True),
+        'energy_end': group_first(df_epc.cooking_event, df_epc.energy, last=True)}
+    columns['cooking_time'] = (columns['time_end'] - columns['time_start']) / np.timedelta64(1, 'm')
+    columns['seq_time'] = (df_epc.timestamp - columns['time_start']) / np.timedelta64(1, 'm')
+    changed = pd.Series(False, index=df_epc.index)
+    for column, values in columns.items():
+        changed |= df_epc[column] != values
+    changed &= df_epc.cooking_event.notnull()
+    changed = df_epc.cooking_event.isin(df_epc.cooking_event[changed].unique())
+
+    # (c): update the changed cooking events
+    for column, values in columns.items():
+        df_epc.loc[changed, column] = values[changed]
+
+    # (d): disqualify the changed cooking events, as the second cooking_event
+    df_epc.loc[
+        (
+            changed
+            & (df_epc.cooking_event != df_epc.cooking_event.shift())
+            & (df_epc.cooking_event != df_epc.cooking_event.shift(-1))
+            & (df_epc.energy.diff() < min_cooking_event)
+            & (df_epc.meter_number == df_epc.meter_number.shift())
+        ), 'cooking_event'] = np.nan
+    energy = df_epc.energy_end - df_epc.energy_start
+    df_epc.loc[changed & ((energy < min_cooking_event) | (energy / (df_epc.cooking_time / 60) < power_mean_min)),
+               'cooking_event'] = np.nan
+    df_epc.loc[df_epc.cooking_event.isnull(), ['cooking_time', 'seq_time']] = np.nan
+
+    df_epc.set_index('timestamp', inplace=True)
+    return df_epc
+
+
+def meter_session(
+        df_raw_meter,
+        engine='pandas',
+        min_cooking_event=0.05,
+        power_mean_min=0.05,
+        min_active_load=0.15,
+        power_capacity=1,
+        time_resolution=5,
+        t_between=15,
+        error_margin=0.04,
+        TZS_per_kWh=100,
+        refine=False):
+    # The full chain of processing steps for the recordings of one meter_number (or of all meters,
+    # as in the script), with the parameters of the steps. refine: refine_events instead of the
+    # second cooking_event.
+    conditions = {'engine': engine, 'min_cooking_event': min_cooking_event, 'power_mean_min': power_mean_min,
+                  'min_active_load': min_active_load, 'power_capacity': power_capacity,
+                  'time_resolution': time_resolution, 't_between': t_between}
+    df_raw_meter = remove_spikes(df_raw_meter)
+    df_processed = cooking_event(df_raw_meter, **conditions)
+    df_epc = timestamp_issue(df_processed, error_margin)
+    df_epc = addtoevent(df_epc, power_capacity, time_resolution)
+    if refine:
+        df_epc = refine_events(df_epc, min_cooking_event, power_mean_min)
+    else:
+        df_epc = cooking_event(df_epc, **conditions)
+    df_only_events = only_events(df_epc, TZS_per_kWh)
+    return df_epc, df_only_events
+
+
+# Peak memory of run_pipeline(..., lean=True) as a multiple of the memory of dataframe_raw as read
+# from a CSV file (memory_usage(deep=True)), checked by benchmark.py --check-lean
+LEAN_MEMORY_TARGET = 2.5
+
+# Columns that are only needed by the steps of cooking_event and addtoevent
+HELPER_COLUMNS = ['load', 'load_count', 'timestamp_load', 'diff_prev_timestamp', 'diff_next_timestamp',
+                  'energy_gap_to_next', 'energy_gap_to_prev']
+
+
+def lean_session(df_raw, params):
+    # meter_session(df_raw, **params) with a peak memory of at most LEAN_MEMORY_TARGET times that of
+    # df_raw as read from a CSV file, instead of about 5 times, and the same cooking events.
+    # (1) How?: df_raw is changed in place instead of copied, the only new frames are those of
+    # timestamp_issue and addtoevent (which drop and add rows, see take_rows), and the helper
+    # columns are deleted as soon as they are not needed anymore. 'load_count' and 'timestamp_load'
+    # are made again by the second cooking_event, while the second pass still depends on 'load' and
+    # 'diff_*_timestamp' of the first one.
+    # (2) Why not less?: cooking_event adds 14 columns, so that df_epc alone is about as large as
+    # dataframe_raw, and a frame with rows added or dropped is held next to the one it is made from.
+    # (3) df_epc is returned without the HELPER_COLUMNS, with a categorical 'timezone' and float32
+    # 'voltage', 'power_factor' and 'frequency' (which are not used by the steps, see compact_schema).
+    # (4) Why params as a dict?: A call with **params holds a reference to df_raw until it returns,
+    # so that it couldn't be freed here.
+    arguments = inspect.signature(meter_session).bind(None, **params)
+    arguments.apply_defaults()
+    params = arguments.arguments
+    conditions = {name: params[name] for name in (
+        'engine', 'min_cooking_event', 'power_mean_min', 'min_active_load', 'power_capacity',
+        'time_resolution', 't_between')}
+    df_epc = remove_spikes(df_raw)
+    del df_raw
+    df_epc['timezone'] = df_epc.timezone.astype('category')
+    for column in ['voltage', 'power_factor', 'frequency']:
+        df_epc[column] = df_epc[column].astype('float32')
+
+    df_epc = cooking_event(df_epc, copy=False, **conditions)
+    delete_columns(df_epc, ['load_count', 'timestamp_load'])
+    df_epc = timestamp_issue(df_epc, params['error_margin'], copy=False)
+    df_epc = addtoevent(df_epc, conditions['power_capacity'], conditions['time_resolution'])
+    delete_columns(df_epc, ['energy_gap_to_next', 'energy_gap_to_prev'])
+    if params['refine']:
+        df_epc = refine_events(df_epc, conditions['min_cooking_event'], conditions['power_mean_min'], copy=False)
+    else:
+        df_epc = cooking_event(df_epc, copy=False, **conditions)
+    delete_columns(df_epc, HELPER_COLUMNS)
+    df_only_events = only_events(df_epc, params['TZS_per_kWh'])
+    return df_epc, df_only_events
+
+
+def delete_columns(df, columns):
+    # del instead of drop(columns=...), which copies all other columns
+    for column in columns:
+        if column in df.columns:
+            del df[column]
+
+
+def renumber_meter(df_epc_meter, df_only_events_meter, offsets):
+    # Renumber 'load_count', 'cooking_event' and 'event_count' of one meter_number to be unique over
+    # all meters, i.e. offset by the number of load instances, cooking starts and events of the
+    # previous meters, as in a serial run. The offsets are updated for the next meter_number.
+    if 'load_count' in df_epc_meter.columns:
+        df_epc_meter.load_count += offsets['load_count']
+    df_epc_meter.cooking_event += offsets['cooking_event']
+    df_only_events_meter.cooking_event += offsets['cooking_event']
+    df_only_events_meter.event_count += offsets['event_count']
+    if len(df_epc_meter):
+        if 'load_count' in df_epc_meter.columns:
+            offsets['load_count'] = int(df_epc_meter.load_count.max())
+        offsets['cooking_event'] += int(df_epc_meter.cooking_start.sum())
+        offsets['event_count'] += len(df_only_events_meter)
+    return df_epc_meter, df_only_events_meter
+
+
+def parallel_meters(df_raw, max_workers=None, **params):
+    # (1) Why split by meter_number?: Every step only compares recordings of the same meter_number,
+    # so each meter can be processed on its own core.
+    # (2) params: the parameters of the processing steps, see meter_session.
+    meters = [df_raw_meter for _, df_raw_meter in df_raw.groupby('meter_number', sort=True)]
+    max_workers = max_workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(partial(meter_session, **params), meters,
+                                    chunksize=max(1, len(meters) // (4 * max_workers))))
+
+    offsets = {'load_count': 0, 'cooking_event': 0, 'event_count': 0}
+    results = [renumber_meter(df_epc_meter, df_only_events_meter, offsets)
+               for df_epc_meter, df_only_events_meter in results]
+
+    df_epc = pd.concat([df_epc_meter for df_epc_meter, _ in results])
+    df_only_events = pd.concat([df_only_events_meter for _, df_only_events_meter in results])
+    return df_epc, df_only_events
+
+
+# The parameters of the first cooking_event of meter_session. The configurations of a sweep with the
+# same values share it.
+EVENT_PARAMETERS = ['engine', 'min_cooking_event', 'power_mean_min', 'min_active_load', 'power_capacity',
+                    'time_resolution', 't_between']
+
+# The recordings after remove_spikes and prepare_timestamps in the processes of sweep
+SWEEP_RECORDINGS = None
+
+
+def sweep(df_raw, grid, max_workers=None, **params):
+    # (1) What?: meter_session for every combination of the values in grid, e.g.
+    # {'t_between': [10, 15, 20], 'min_active_load': [0.1, 0.15]}, with params for the other parameters.
+    # Returns one row per configuration with its parameters, the number of cooking events and their
+    # energy_gen, cooking_time and cooking_cost, in the order of itertools.product(*grid.values()).
+    # (2) Why not meter_session for each?: remove_spikes and prepare_timestamps don't depend on the
+    # parameters and run once. The first cooking_event only depends on EVENT_PARAMETERS, so it
+    # runs once for the configurations with the same values (e.g. that differ in error_margin or
+    # TZS_per_kWh), and the groups of configurations run in parallel (see sweep_group).
+    # (3) max_workers: processes for the groups, None for one per CPU and 1 for this process only.
+    configs = []
+    for values in itertools.product(*grid.values()):
+        arguments = inspect.signature(meter_session).bind(None, **dict(params, **dict(zip(grid, values))))
+        arguments.apply_defaults()
+        configs.append({name: value for name, value in arguments.arguments.items() if name != 'df_raw_meter'})
+    groups = {}
+    for number, config in enumerate(configs):
+        groups.setdefault(tuple(config[name] for name in EVENT_PARAMETERS), []).append((number, config))
+
+    df_prepared = prepare_timestamps(remove_spikes(df_raw.copy()))
+    if max_workers == 1:
+        set_sweep_recordings(df_prepared)
+        results = [sweep_group(group) for group in groups.values()]
+        set_sweep_recordings(None)
+    else:
+        max_workers = max_workers or os.cpu_count()
+        # the recordings are sent to each process once, instead of with every group
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=set_sweep_recordings,
+                                 initargs=(df_prepared,)) as executor:
+            results = list(executor.map(sweep_group, groups.values()))
+
+    rows = sorted(row for result in results for row in result)
+    return pd.DataFrame([dict(configs[number], **summary) for number, summary in rows])
+
+
+def set_sweep_recordings(df_prepared):
+    global SWEEP_RECORDINGS
+    SWEEP_RECORDINGS = df_prepared
+
+
+def sweep_group(group):
+    # The summaries of the configurations (number, config) of sweep that share the first
+    # cooking_event, as (number, summary). The recordings after addtoevent are shared by the
+    # configurations with the same error_margin, and df_epc by those with the same error_margin
+    # and refine.
+    conditions = {name: group[0][1][name] for name in EVENT_PARAMETERS}
+    df_processed = cooking_event(SWEEP_RECORDINGS, prepared=True, **conditions)
+    extended, epcs = {}, {}
+    rows = []
+    for number, config in group:
+        error_margin, refine = config['error_margin'], config['refine']
+        if error_margin not in extended:
+            extended[error_margin] = addtoevent(
+                timestamp_issue(df_processed, error_margin), config['power_capacity'], config['time_resolution'])
+        if (error_margin, refine) not in epcs:
+            if refine:
+                df_epc = refine_events(extended[error_margin], config['min_cooking_event'], config['power_mean_min'])
+            else:
+                df_epc = cooking_event(extended[error_margin], **conditions)
+            epcs[error_margin, refine] = df_epc
+        df_only_events = only_events(epcs[error_margin, refine], config['TZS_per_kWh'])
+        rows.append((number, {
+            'events': len(df_only_events),
+            'energy_gen': df_only_events.energy_gen.sum(),
+            'cooking_time': df_only_events.cooking_time.sum(),
+            'cooking_cost': df_only_events.cooking_cost.sum()}))
+    return rows
+
+
+def stream_events(path, chunksize=100000, sep=',', context_events=2, **params):
+    # (1) Why a generator?: The cooking events are yielded as soon as they are final, so only the
+    # current chunk and the state of one meter_number are held in memory.
+    # (2) Why update_meter?: The recordings of a meter_number might continue in the next chunk, and
+    # event_conditions needs the neighbouring rows and the t_between look-back. update_meter carries
+    # only the recordings from context_events cooking events before the open one (its tail) to the
+    # next chunk, instead of all recordings of the meter_number, so the memory is bounded by chunksize
+    # and the recordings of a few cooking events, also for a long meter_number.
+    # (3) The cooking events before the open one are final, and the others once the meter_number ends.
+    # 'cooking_event' and 'event_count' are offset by those of the previous meters, as in a serial run.
+    # (4) The recordings have to be grouped by meter_number, as in dataframe_raw.csv. A meter_number
+    # that appears again after other meters raises a ValueError, as its state is gone.
+    # (5) params: the parameters of the processing steps, see meter_session.
+    offsets = {'cooking_event': 0, 'event_count': 0}
+    meter_number, state, open_events = None, None, None
+    ended = set()
+    for chunk in pd.read_csv(path, sep=sep, chunksize=chunksize):
+        for number, df_new_meter in chunk.groupby('meter_number', sort=False):
+            if number != meter_number:
+                if number in ended:
+                    raise ValueError('meter_number {} appears again after other meters, sort the '
+                                     'recordings by meter_number'.format(number))
+                if meter_number is not None:
+                    yield end_meter(open_events, state, offsets)
+                    ended.add(meter_number)
+                meter_number, state = number, None
+            df_only_events, state = update_meter(df_new_meter, state, context_events, **params)
+            final = (df_only_events.cooking_event < state['cooking_event']).to_numpy()
+            if final.any():
+                yield offset_events(df_only_events[final], offsets)
+            open_events = df_only_events[~final]
+
+    if meter_number is not None:
+        yield end_meter(open_events, state, offsets)
+
+
+def offset_events(df_only_events_meter, offsets):
+    # The cooking events of a meter_number numbered after those of the previous meters, see renumber_meter
+    df_only_events_meter = df_only_events_meter.copy()
+    df_only_events_meter.cooking_event += offsets['cooking_event']
+    df_only_events_meter.event_count += offsets['event_count']
+    return df_only_events_meter
+
+
+def end_meter(open_events, state, offsets):
+    # The open cooking events of the last meter_number, and the offsets for the next meter_number
+    df_only_events_meter = offset_events(open_events, offsets)
+    offsets['cooking_event'] += state['cooking_starts']
+    if len(open_events):
+        offsets['event_count'] += int(open_events.event_count.iloc[-1])
+    return df_only_events_meter
+
+
+def update_meter(df_new_meter, state=None, context_events=2, **params):
+    # (1) Why a state?: Only the recordings from a few cooking events back are processed again together
+    # with the new recordings, instead of the whole history of the meter_number.
+    # (2) Why context_events?: event_conditions, timestamp_issue and addtoevent look at neighbouring
+    # rows and the previous cooking event, so the tail starts context_events events before the first
+    # cooking event that is emitted again (the 'open' event, which new recordings may still change).
+    # (3) 'cooking_event' and 'event_count' are numbered per meter_number, as by meter_session on the
+    # full history of the meter.
+    # (4) The returned cooking events replace the earlier ones of the meter_number from the open cooking
+    # event on, i.e. from state['cooking_event'] before the update (1 for a new meter_number).
+    # (5) Why no last energy reading or timestamp_load in the state?: They are in the recordings of the
+    # tail, which are processed again. state['cooking_starts'] is the number of 'cooking_start' of the
+    # meter_number so far, by which stream_events numbers the next meter_number.
+    # (6) params: the parameters of the processing steps, see meter_session.
+    df_new_meter = normalize_timestamps(df_new_meter.copy())
+    if state is None:
+        state = {'tail': df_new_meter.iloc[:0], 'time_start': None, 'cooking_event': 1, 'event_count': 1}
+    df_raw_meter = pd.concat([state['tail'], df_new_meter], ignore_index=True)
+
+    df_epc, df_only_events = meter_session(df_raw_meter.copy(), **params)
+
+    # The next update starts at the last but one cooking event, with context_events before it
+    if len(df_only_events) >= 2 + context_events:
+        tail = df_raw_meter.loc[df_raw_meter.timestamp >= df_only_events.index[-2 - context_events]]
+    else:
+        tail = df_raw_meter
+
+    # offsets from the open cooking event of the previous update
+    offset = 0
+    if state['time_start'] is not None:
+        df_only_events = df_only_events.loc[df_only_events.index >= state['time_start']].copy()
+        if not len(df_only_events) or df_only_events.index[0] != state['time_start']:
+            raise ValueError('The open cooking event of meter_number {} has changed, '
+                             'process it again with a larger context_events'.format(
+                                 df_new_meter.meter_number.iloc[0]))
+        offset = state['cooking_event'] - df_only_events.cooking_event.iloc[0]
+        df_only_events.cooking_event += offset
+        df_only_events.event_count += state['event_count'] - df_only_events.event_count.iloc[0]
+
+    if len(df_only_events) >= 2:
+        state['time_start'] = df_only_events.index[-2]
+        state['cooking_event'] = df_only_events.cooking_event.iloc[-2]
+        state['event_count'] = df_only_events.event_count.iloc[-2]
+    state['tail'] = tail
+    state['cooking_starts'] = int(offset + df_epc.cooking_start.sum())
+    return df_only_events, state
+
+
+def update_events(df_new, state_path, context_events=2, **params):
+    # Process new recordings of several meter_numbers, with the state of each meter_number saved as
+    # a pickle in the directory state_path. Returns the new and updated cooking events, and per
+    # meter_number the 'cooking_event' from which they replace the earlier ones. params: the
+    # parameters of the processing steps, see meter_session.
+    os.makedirs(state_path, exist_ok=True)
+    events = []
+    replace_from = {}
+    for meter_number, df_new_meter in df_new.groupby('meter_number', sort=True):
+        state_file = os.path.join(state_path, '{}.pkl'.format(meter_number))
+        state = pd.read_pickle(state_file) if os.path.exists(state_file) else None
+        replace_from[meter_number] = state['cooking_event'] if state is not None else 1
+        df_only_events_meter, state = update_meter(df_new_meter, state, context_events, **params)
+        pd.to_pickle(state, state_file)
+        events.append(df_only_events_meter)
+    if not events:
+        # no new recordings: no cooking events, with the columns of only_events
+        return meter_session(df_new.copy(), **params)[1], pd.Series([], name='cooking_event', dtype=float)
+    return pd.concat(events), pd.Series(replace_from, name='cooking_event')
+
+
+# float32 columns of the compact schema for Parquet/Arrow files. 'energy' and 'power' stay float64,
+# as the event conditions compare them with the thresholds.
+ELECTRICAL_COLUMNS = ['voltage', 'current', 'power_factor', 'frequency']
+
+
+def compact_schema(df):
+    # dataframe_raw, df_epc or df_only_events with compact dtypes: categorical 'timezone', the smallest
+    # integer for 'meter_number' (dictionary encoded in Parquet), float32 electrical measurements,
+    # datetime64 timestamps and nullable integer 'cooking_event'.
+    dtypes = {column: 'float32' for column in ELECTRICAL_COLUMNS if column in df.columns}
+    if 'timezone' in df.columns:
+        dtypes['timezone'] = 'category'
+    if 'cooking_event' in df.columns:
+        dtypes['cooking_event'] = 'Int64'
+    df = df.astype(dtypes)
+    if 'meter_number' in df.columns:
+        df['meter_number'] = pd.to_numeric(df.meter_number, downcast='integer')
+    if 'timestamp' in df.columns:
+        df['timestamp'] = pd.to_datetime(df.timestamp)
+    return df
+
+
+def write_parquet(df, path, row_group_size=100000):
+    # Sorted by meter_number and timestamp, so that the row group statistics allow to skip
+    # meters and time ranges when reading.
+    df = compact_schema(df)
+    if df.index.name == 'timestamp':
+        df = df.reset_index()
+    df = df.sort_values(by=['meter_number', 'timestamp'], kind='stable')
+    df.to_parquet(path, engine='pyarrow', index=False, row_group_size=row_group_size,
+                  use_dictionary=['meter_number', 'timezone'])
+
+
+def read_parquet(path, columns=None, meter_numbers=None, start=None, end=None, index=None):
+    # Read only the given columns, meter_numbers and timestamps from start (incl.) to end (excl.);
+    # the filters are pushed down to the row groups. index='timestamp' sets the timestamp index of
+    # df_epc and df_only_events.
+    filters = []
+    if meter_numbers is not None:
+        filters.append(('meter_number', 'in', list(meter_numbers)))
+    if start is not None:
+        filters.append(('timestamp', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('timestamp', '<', pd.Timestamp(end)))
+    if columns is not None and index is not None and index not in columns:
+        columns = list(columns) + [index]
+    df = pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters or None)
+    if index is not None:
+        df.set_index(index, inplace=True)
+    return df
+
+
+# Arrays of the index of build_index, saved as <name>.npy by save_index
+INDEX_ARRAYS = ['position', 'timestamp', 'meter_number', 'offset']
+
+
+def build_index(df):
+    # (1) Why an index?: Queries for one meter_number and time range, e.g. a week of one meter, are
+    # answered by binary search instead of a mask over the whole df_epc or df_only_events.
+    # (2) position: the rows of df sorted by meter_number and timestamp (as the row numbers of df),
+    # timestamp: their timestamps (int64 nanoseconds), meter_number: the distinct meter numbers,
+    # offset: where the rows of each meter_number start in position, plus the number of rows.
+    # df has the timestamp as index or column, as the outputs of the script.
+    timestamp = df.index if 'timestamp' not in df.columns else df.timestamp
+    timestamp = pd.to_datetime(timestamp).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    meter_number = df.meter_number.to_numpy()
+    position = np.lexsort((timestamp, meter_number))
+    meter_number = meter_number[position]
+    first = np.flatnonzero(np.r_[True, meter_number[1:] != meter_number[:-1]]) if len(position) else np.array([], dtype=np.int64)
+    return {'position': position,
+            'timestamp': timestamp[position],
+            'meter_number': meter_number[first],
+            'offset': np.append(first, len(position)).astype(np.int64)}
+
+
+def index_positions(index, meter_number=None, start=None, end=None):
+    # The row numbers of the rows of meter_number (one or several, all if None) with a timestamp from
+    # start (incl.) to end (excl.), in the order of the index
+    if meter_number is None:
+        meters = range(len(index['meter_number']))
+    else:
+        meter_numbers = np.atleast_1d(meter_number)
+        meters = np.searchsorted(index['meter_number'], meter_numbers)
+        meters = [meter for meter, number in zip(meters, meter_numbers)
+                  if meter < len(index['meter_number']) and index['meter_number'][meter] == number]
+    slices = []
+    for meter in meters:
+        first, last = index['offset'][meter], index['offset'][meter + 1]
+        timestamp = index['timestamp'][first:last]
+        if start is not None:
+            first += np.searchsorted(timestamp, pd.Timestamp(start).value, side='left')
+        if end is not None:
+            last = index['offset'][meter] + np.searchsorted(timestamp, pd.Timestamp(end).value, side='left')
+        slices.append(index['position'][first:last])
+    return np.concatenate(slices) if slices else np.array([], dtype=np.int64)
+
+
+def query(df, index, meter_number=None, start=None, end=None):
+    # The rows of df (as indexed by build_index) of meter_number from start to end, see index_positions
+    return df.take(index_positions(index, meter_number, start, end))
+
+
+def save_index(index, path):
+    # One .npy file per array in the directory path, so that load_index can memory-map them
+    os.makedirs(path, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), index[name])
+
+
+def load_index(path, mmap_mode='r'):
+    # The arrays are memory-mapped (unless mmap_mode=None), i.e. only the pages that a query
+    # touches are read from the disk
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in INDEX_ARRAYS}
+
+
+# Arrays of the events of the event store (one value per cooking event), see build_event_store
+EVENT_STORE_ARRAYS = ['meter_number', 'cooking_event', 'start', 'end', 'energy_gen', 'power_mean', 'cooking_cost',
+                      'no_recordings']
+
+# Rollups of the event store, and their arrays (one value per meter_number and day, week or month)
+ROLLUPS = ['daily', 'weekly', 'monthly']
+ROLLUP_ARRAYS = ['meter_number', 'period', 'events', 'energy_gen', 'cooking_time', 'cooking_cost']
+
+
+def build_event_store(df_only_events):
+    # (1) Why an event store?: Reports and plots need the per-event fields and their sums per day,
+    # week or month, not the recordings. The store keeps them as NumPy arrays, and the sums
+    # (rollups) are updated with the cooking events by add_events instead of aggregated again.
+    # (2) events: EVENT_STORE_ARRAYS of the cooking events of df_only_events, sorted by meter_number
+    # and start. The end is the start plus the cooking_time.
+    # (3) 'daily', 'weekly' (from Monday) and 'monthly': ROLLUP_ARRAYS, the number of cooking events
+    # and the sums of their energy_gen, cooking_time (minutes) and cooking_cost per meter_number and
+    # period (the first day), by the start of the cooking events.
+    store = {'events': event_arrays(df_only_events.iloc[:0])}
+    return add_events(store, df_only_events)
+
+
+def event_arrays(df_only_events):
+    # EVENT_STORE_ARRAYS of df_only_events (the cooking events with the timestamp of their start as
+    # index, as by only_events), sorted by meter_number and start
+    start = df_only_events.index.to_numpy(dtype='datetime64[ns]')
+    events = {
+        'meter_number': df_only_events.meter_number.to_numpy(dtype=np.int64),
+        'cooking_event': df_only_events.cooking_event.to_numpy(dtype=np.int64),
+        'start': start,
+        'end': start + pd.to_timedelta(df_only_events.cooking_time, unit='m').to_numpy(),
+        'energy_gen': df_only_events.energy_gen.to_numpy(dtype=float),
+        'power_mean': df_only_events.power_mean.to_numpy(dtype=np.float32),
+        'cooking_cost': df_only_events.cooking_cost.to_numpy(dtype=float),
+        'no_recordings': df_only_events.no_recordings.to_numpy(dtype=np.int32)}
+    order = np.lexsort((events['start'], events['meter_number']))
+    return {name: values[order] for name, values in events.items()}
+
+
+def rollup_period(start, rollup):
+    # The first day of the day, week (from Monday) or month of the timestamps start
+    day = start.astype('datetime64[D]')
+    if rollup == 'weekly':
+        # 1970-01-01 was a Thursday
+        day = day - (day.astype(np.int64) + 3) % 7
+    elif rollup == 'monthly':
+        day = start.astype('datetime64[M]')
+    return day.astype('datetime64[ns]')
+
+
+def rollup_arrays(events, rollup):
+    # ROLLUP_ARRAYS of the events (EVENT_STORE_ARRAYS), sorted by meter_number and period. The sums
+    # skip NaN and equal those of groupby(...).sum(), see event_sum.
+    period = rollup_period(events['start'], rollup)
+    order = np.lexsort((period, events['meter_number']))
+    meter_number, period = events['meter_number'][order], period[order]
+    starts = np.flatnonzero(np.concatenate([[True], (meter_number[1:] != meter_number[:-1]) | (
+        period[1:] != period[:-1])]))[:len(order)]
+    cooking_time = (events['end'] - events['start']) / np.timedelta64(1, 'm')
+    return {'meter_number': meter_number[starts],
+            'period': period[starts],
+            'events': np.diff(np.append(starts, len(order))),
+            'energy_gen': event_sum(events['energy_gen'][order], starts)[0],
+            'cooking_time': event_sum(cooking_time[order], starts)[0],
+            'cooking_cost': event_sum(events['cooking_cost'][order], starts)[0]}
+
+
+def add_events(store, df_only_events):
+    # (1) Adds the cooking events of df_only_events to the store (changed in place and returned). The
+    # cooking events of a meter_number in the store from its first cooking_event in df_only_events on
+    # are replaced, as the cooking events of update_meter and update_events replace the earlier ones.
+    # (2) Why are the rollups of the meters computed again?: They are computed from the cooking events
+    # in the store (not from the recordings), only for the meter_numbers in df_only_events, and so
+    # equal those of build_event_store on all cooking events.
+    new = event_arrays(df_only_events)
+    events = store['events']
+    replace_from = pd.Series(new['cooking_event']).groupby(new['meter_number']).min()
+    keep = ~(events['cooking_event'] >= replace_from.reindex(events['meter_number']).to_numpy())
+    events = {name: np.concatenate([events[name][keep], new[name]]) for name in EVENT_STORE_ARRAYS}
+    order = np.lexsort((events['start'], events['meter_number']))
+    store['events'] = events = {name: values[order] for name, values in events.items()}
+
+    is_new_meter = np.isin(events['meter_number'], replace_from.index)
+    new_events = {name: values[is_new_meter] for name, values in events.items()}
+    for rollup in ROLLUPS:
+        arrays = rollup_arrays(new_events, rollup)
+        if rollup in store:
+            keep = ~np.isin(store[rollup]['meter_number'], replace_from.index)
+            arrays = {name: np.concatenate([store[rollup][name][keep], arrays[name]]) for name in ROLLUP_ARRAYS}
+        order = np.lexsort((arrays['period'], arrays['meter_number']))
+        store[rollup] = {name: values[order] for name, values in arrays.items()}
+    return store
+
+
+def event_store_frame(store, rollup='events', meter_number=None, start=None, end=None):
+    # The events (by their start) or a rollup (by its period) of the store as a DataFrame, for
+    # meter_number (one or several, all if None) from start (incl.) to end (excl.)
+    arrays = store[rollup]
+    time = arrays['start' if rollup == 'events' else 'period']
+    rows = np.ones(len(time), dtype=bool)
+    if meter_number is not None:
+        rows &= np.isin(arrays['meter_number'], np.atleast_1d(meter_number))
+    if start is not None:
+        rows &= time >= pd.Timestamp(start).to_datetime64()
+    if end is not None:
+        rows &= time < pd.Timestamp(end).to_datetime64()
+    df = pd.DataFrame({name: np.asarray(values)[rows] for name, values in arrays.items()})
+    return df.set_index('start' if rollup == 'events' else 'period')
+
+
+def save_event_store(store, path):
+    # One .npy file per array in a directory per part of the store (events and the rollups), so that
+    # load_event_store can memory-map them. The files are replaced, so that a store that is loaded
+    # from path can be saved there again.
+    for part in ['events'] + ROLLUPS:
+        os.makedirs(os.path.join(path, part), exist_ok=True)
+        for name, values in store[part].items():
+            file = os.path.join(path, part, name + '.npy')
+            with open(file + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(file + '.tmp', file)
+
+
+def load_event_store(path, mmap_mode='r'):
+    # The arrays are memory-mapped (unless mmap_mode=None), see load_index
+    return {part: {name: np.load(os.path.join(path, part, name + '.npy'), mmap_mode=mmap_mode)
+                   for name in (EVENT_STORE_ARRAYS if part == 'events' else ROLLUP_ARRAYS)}
+            for part in ['events'] + ROLLUPS}
+
+
+def file_format(path, format=None):
+    # 'parquet' for .parquet/.pq files, otherwise 'csv', unless format is given
+    if format is not None:
+        return format
+    return 'parquet' if os.path.splitext(str(path))[1].lower() in ('.parquet', '.pq') else 'csv'
+
+
+def read_source(source, format=None):
+    # dataframe_raw from a DataFrame (copied, as remove_spikes changes it), a CSV or a Parquet file
+    if isinstance(source, pd.DataFrame):
+        return source.copy()
+    if file_format(source, format) == 'parquet':
+        return read_parquet(source)
+    return pd.read_csv(source, sep=',')
+
+
+def write_output(df, path, format=None):
+    if file_format(path, format) == 'parquet':
+        write_parquet(df, path)
+    else:
+        df.to_csv(path)
+
+
+def run_pipeline(source, format=None, max_workers=1, period_range=None, lean=False, **params):
+    # (1) source: dataframe_raw as a DataFrame or the path of a CSV or Parquet file (see file_format).
+    # (2) params: the parameters of the processing steps, e.g. min_active_load, t_between,
+    # time_resolution, TZS_per_kWh, engine or refine, see meter_session.
+    # (3) max_workers: 1 processes all meters together in this process, as the script always did,
+    # otherwise by parallel_meters (None for one worker per CPU).
+    # (4) period_range: (start, end) to keep only the cooking events in between, see period.
+    # (5) lean: keep the peak memory to at most LEAN_MEMORY_TARGET times that of dataframe_raw as read
+    # from the source file, see lean_session. df_epc has then no helper columns. A DataFrame source is changed
+    # in place instead of copied, and the target only holds if it is not referenced elsewhere.
+    # Returns df_epc and df_only_events.
+    if lean:
+        if max_workers != 1:
+            raise ValueError('lean is only for max_workers=1')
+        # no reference to dataframe_raw is kept here, so that lean_session can free it
+        df_epc, df_only_events = lean_session(
+            source if isinstance(source, pd.DataFrame) else read_source(source, format), params)
+    elif max_workers == 1:
+        df_epc, df_only_events = meter_session(read_source(source, format), **params)
+    else:
+        df_epc, df_only_events = parallel_meters(read_source(source, format), max_workers, **params)
+    if period_range is not None:
+        df_only_events = period(df_only_events, *period_range)
+    return df_epc, df_only_events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Define the cooking events of EPC smart meter recordings.')
+    parser.add_argument('input', nargs='?', default='dataframe_raw.csv',
+                        help='CSV or Parquet file of the raw recordings (default: dataframe_raw.csv)')
+    parser.add_argument('--input-format', choices=['csv', 'parquet'], help='default: by the file extension')
+    parser.add_argument('-o', '--output', help='file for df_only_events, printed if not given')
+    parser.add_argument('--epc-output', help='file for df_epc, the recordings with their cooking event')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], help='default: by the file extension')
+    parser.add_argument('--min-active-load', type=float)
+    parser.add_argument('--power-capacity', type=float)
+    parser.add_argument('--t-between', type=float, help='minutes')
+    parser.add_argument('--time-resolution', type=float, help='minutes')
+    parser.add_argument('--tzs-per-kwh', dest='TZS_per_kWh', type=float)
+    parser.add_argument('--min-cooking-event', type=float)
+    parser.add_argument('--power-mean-min', type=float)
+    parser.add_argument('--engine', choices=['pandas', 'numpy'])
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='processes for the meters, 0 for one per CPU (default: 1)')
+    parser.add_argument('--lean', action='store_true',
+                        help='use at most {} times the memory of the input (without helper columns in df_epc)'.format(
+                            LEAN_MEMORY_TARGET))
+    parser.add_argument('--refine', action='store_true',
+                        help='update the cooking events after adding their start and end instead of defining them again')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='read the results of the stages from DIR if they ran with the same input and parameters '
+                             'before, and write them there otherwise (see stage_cache)')
+    parser.add_argument('--period', nargs=2, metavar=('START', 'END'),
+                        help='keep only the cooking events from START to END, e.g. 2020-03-09 2020-11-15')
+    parser.add_argument('--store', metavar='DIR',
+                        help='save the cooking events and their daily, weekly and monthly sums in DIR '
+                             '(see build_event_store)')
+    args = parser.parse_args(argv)
+
+    # only the parameters that are given, the others keep the defaults of meter_session
+    params = {name: value for name, value in vars(args).items() if value is not None and name in (
+        'min_active_load', 'power_capacity', 't_between', 'time_resolution', 'TZS_per_kWh',
+        'min_cooking_event', 'power_mean_min', 'engine')}
+    if args.refine:
+        params['refine'] = True
+    with stage_cache(args.cache) if args.cache else nullcontext():
+        df_epc, df_only_events = run_pipeline(args.input, format=args.input_format,
+                                              max_workers=args.workers or None, period_range=args.period,
+                                              lean=args.lean, **params)
+    if args.epc_output:
+        write_output(df_epc, args.epc_output, args.output_format)
+    if args.store:
+        save_event_store(build_event_store(df_only_events), args.store)
+    if args.output:
+        write_output(df_only_events, args.output, args.output_format)
+    else:
+        print(df_only_events)
 
-df_raw = remove_spikes(df_raw)
-df_processed = cooking_event(df_raw)
-df_epc = timestamp_issue(df_processed)
-df_epc = addtoevent_ending(df_epc)
-df_epc = addtoevent_beginning(df_epc)
-df_epc = cooking_event(df_epc)
-df_only_events = only_events(df_epc)
-df_period = period(df_only_events)
 
-#df_epc = df_epc.loc[df_epc['meter_number']==546375]
+if __name__ == '__main__':
+    main()
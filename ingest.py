@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ingest the recordings of the smart meters as they are uploaded and define their cooking events.
+
+Usage: python ingest.py http://localhost:8000 --interval 60 --output df_only_events.csv
+       python ingest.py serve dataframe_raw.csv --port 8000
+"""
+# Packages
+import argparse
+import asyncio
+import http.client
+import http.server
+import io
+import json
+import os
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+import pandas as pd
+
+import cooking_session
+
+
+class HttpSource:
+    # (1) The recordings of a meter gateway (or of serve below): GET /meters returns the meter_numbers
+    # as JSON, GET /readings?meter_number=M&after_id=N the recordings of meter M with an 'id' above N
+    # as CSV, in the columns of dataframe_raw.csv.
+    # (2) Why a pool of connections?: The meters are fetched concurrently over at most max_connections
+    # kept-alive connections instead of a new connection per request.
+    # (3) Why is the connection held until the batch is queued?: backpressure, when the processing
+    # falls behind, at most max_connections batches wait for the queue.
+    def __init__(self, url, max_connections=8, timeout=60):
+        url = urllib.parse.urlsplit(url)
+        self.host, self.port, self.path = url.hostname, url.port, url.path.rstrip('/')
+        self.timeout = timeout
+        self.connections = asyncio.Queue()
+        for _ in range(max_connections):
+            self.connections.put_nowait(None)
+        self.after_id = {}
+
+    def request(self, connection, path):
+        # GET path on connection, once more on a new connection if the server closed it in between
+        for attempt in range(2):
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                connection.request('GET', self.path + path)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                connection = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise ConnectionError('GET {} returned {} {}'.format(path, response.status, response.reason))
+        return connection, body
+
+    async def get(self, path, queue=None):
+        # The body of GET path, or with queue, the recordings in it put on the queue
+        connection = await self.connections.get()
+        try:
+            connection, body = await asyncio.to_thread(self.request, connection, path)
+            if queue is None:
+                return body
+            df_new = pd.read_csv(io.BytesIO(body), sep=',')
+            if len(df_new):
+                await queue.put(df_new)
+            return df_new
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            connection = None
+            raise
+        finally:
+            self.connections.put_nowait(connection)
+
+    async def fetch(self, queue):
+        # Put the new recordings of each meter_number on the queue, one DataFrame per meter_number
+        meter_numbers = json.loads(await self.get('/meters'))
+
+        async def fetch_meter(meter_number):
+            df_new = await self.get('/readings?meter_number={}&after_id={}'.format(
+                meter_number, self.after_id.get(meter_number, 0)), queue)
+            if len(df_new):
+                self.after_id[meter_number] = df_new.id.max()
+
+        await asyncio.gather(*(fetch_meter(meter_number) for meter_number in meter_numbers))
+
+    def close(self):
+        while not self.connections.empty():
+            connection = self.connections.get_nowait()
+            if connection is not None:
+                connection.close()
+
+
+class FileDropSource:
+    # The recordings as CSV files (in the columns of dataframe_raw.csv) that the gateways drop in a
+    # directory. The files are read once each, in the order of their names, so the names have to
+    # sort in the order of the uploads, e.g. by a timestamp.
+    def __init__(self, path):
+        self.path = path
+        self.read = set()
+
+    async def fetch(self, queue):
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.csv') or name in self.read:
+                continue
+            df_new = await asyncio.to_thread(pd.read_csv, os.path.join(self.path, name), sep=',')
+            self.read.add(name)
+            for _, df_new_meter in df_new.groupby('meter_number', sort=False):
+                await queue.put(df_new_meter)
+
+    def close(self):
+        pass
+
+
+async def ingest(source, interval=60, rounds=None, queue_size=16, context_events=2):
+    # (1) Why asyncio?: The next recordings are fetched while the previous ones are processed, and
+    # the meters are fetched concurrently, see HttpSource.
+    # (2) source: HttpSource, FileDropSource or another object with an async fetch(queue) that puts
+    # the new recordings on the queue, one DataFrame per meter_number, in the order of the uploads.
+    # (3) interval: seconds between the fetches, rounds: number of fetches (None for no end).
+    # (4) queue_size: batches of recordings that are fetched ahead of the processing.
+    # (5) Yields (meter_number, df_only_events, replace_from) as the recordings are processed by
+    # update_meter, with the state of each meter_number in memory: the new and updated cooking events,
+    # which replace the earlier ones of the meter_number from the cooking_event replace_from on.
+    queue = asyncio.Queue(queue_size)
+
+    async def fetch():
+        try:
+            fetched = 0
+            while rounds is None or fetched < rounds:
+                started = asyncio.get_running_loop().time()
+                await source.fetch(queue)
+                fetched += 1
+                if rounds is None or fetched < rounds:
+                    await asyncio.sleep(max(0, started + interval - asyncio.get_running_loop().time()))
+        except Exception:
+            # the processing stops at None and raises the error by awaiting fetcher
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    fetcher = asyncio.create_task(fetch())
+    states = {}
+    try:
+        while (df_new_meter := await queue.get()) is not None:
+            meter_number = df_new_meter.meter_number.iloc[0]
+            state = states.get(meter_number)
+            replace_from = state['cooking_event'] if state is not None else 1
+            df_only_events, states[meter_number] = await asyncio.to_thread(
+                cooking_session.update_meter, df_new_meter, state, context_events)
+            yield meter_number, df_only_events, replace_from
+        await fetcher
+    finally:
+        fetcher.cancel()
+        source.close()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # The requests of HttpSource, on the recordings of the server (self.server.df_raw). POST /readings
+    # with recordings as CSV adds them, as a meter gateway does.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        with self.server.lock:
+            df_raw = self.server.df_raw
+        if url.path == '/meters':
+            self.reply(json.dumps(sorted(df_raw.meter_number.unique().tolist())).encode(), 'application/json')
+        elif url.path == '/readings':
+            rows = df_raw.id > int(query.get('after_id', ['0'])[0])
+            if 'meter_number' in query:
+                rows &= df_raw.meter_number == int(query['meter_number'][0])
+            self.reply(df_raw[rows].to_csv(index=False).encode(), 'text/csv')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != '/readings':
+            self.send_error(404)
+            return
+        df_new = pd.read_csv(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))), sep=',')
+        self.server.upload(df_new)
+        self.reply(b'', 'text/plain')
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    # A local stand-in for the meter gateways, e.g. for tests: it serves the recordings df_raw
+    # (in the columns of dataframe_raw.csv) to HttpSource. upload adds recordings.
+    daemon_threads = True
+
+    def __init__(self, df_raw, address=('127.0.0.1', 0)):
+        super().__init__(address, StandInHandler)
+        self.lock = threading.Lock()
+        self.df_raw = df_raw.iloc[:0]
+        self.upload(df_raw)
+
+    def upload(self, df_new):
+        # the recordings get an 'id' after the last one if they have none
+        with self.lock:
+            if 'id' not in df_new.columns:
+                start = int(self.df_raw.id.max()) + 1 if len(self.df_raw) else 1
+                df_new = df_new.assign(id=range(start, start + len(df_new)))
+            self.df_raw = pd.concat([self.df_raw, df_new], ignore_index=True) if len(self.df_raw) else df_new
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+@contextmanager
+def serve(df_raw, address=('127.0.0.1', 0)):
+    # StandInServer running in a thread, e.g. with serve(df_raw) as server: ingest(HttpSource(server.url))
+    server = StandInServer(df_raw, address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+async def ingest_to_file(source, path, store=None, **params):
+    # Keep the cooking events of all meters in the CSV file path (and in the event store in the
+    # directory store, see cooking_session.build_event_store) up to date, see ingest
+    df_only_events = pd.read_csv(path, index_col='timestamp', parse_dates=True) if os.path.exists(path) else None
+    event_store = None
+    if store is not None and os.path.exists(store):
+        event_store = cooking_session.load_event_store(store)
+    async for meter_number, df_only_events_meter, replace_from in ingest(source, **params):
+        if df_only_events is not None:
+            df_only_events = pd.concat([df_only_events[
+                (df_only_events.meter_number != meter_number) | (df_only_events.cooking_event < replace_from)],
+                df_only_events_meter])
+        else:
+            df_only_events = df_only_events_meter
+        df_only_events.to_csv(path)
+        if store is not None:
+            if event_store is None:
+                event_store = cooking_session.build_event_store(df_only_events_meter)
+            else:
+                cooking_session.add_events(event_store, df_only_events_meter)
+            cooking_session.save_event_store(event_store, store)
+        print('meter_number {}: {} new or updated cooking events'.format(meter_number, len(df_only_events_meter)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', help="URL of the meter gateway, directory of the dropped CSV files or 'serve'")
+    parser.add_argument('input', nargs='?', help='with serve: CSV file of the recordings to serve')
+    parser.add_argument('-o', '--output', default='df_only_events.csv', help='CSV file of the cooking events')
+    parser.add_argument('--store', metavar='DIR', help='also keep the cooking events and their daily, weekly and '
+                                                       'monthly sums up to date in the event store in DIR')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between the fetches')
+    parser.add_argument('--rounds', type=int, help='number of fetches (default: no end)')
+    parser.add_argument('--connections', type=int, default=8, help='connections to the meter gateway')
+    parser.add_argument('--queue-size', type=int, default=16, help='batches fetched ahead of the processing')
+    parser.add_argument('--port', type=int, default=8000, help='with serve: port of the stand-in server')
+    args = parser.parse_args(argv)
+
+    if args.source == 'serve':
+        df_raw = pd.read_csv(args.input, sep=',') if args.input else pd.DataFrame(
+            columns=['id', 'meter_number', 'timezone', 'timestamp', 'energy', 'voltage', 'current', 'power',
+                     'power_factor', 'frequency'])
+        with StandInServer(df_raw, ('', args.port)) as server:
+            print('serving the recordings on port {}'.format(args.port))
+            server.serve_forever()
+        return
+
+    if os.path.isdir(args.source):
+        source = FileDropSource(args.source)
+    else:
+        source = HttpSource(args.source, args.connections)
+    asyncio.run(ingest_to_file(source, args.output, args.store, interval=args.interval, rounds=args.rounds,
+                               queue_size=args.queue_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the cooking_session pipeline on synthetic meter data (see benchmark.py).
+
+Usage: python -m pytest test_cooking_session.py
+"""
+# Packages
+import asyncio
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import cooking_session
+import ingest
+
+# Columns set by event_conditions and event_conditions_numpy that the engines have to agree on
+ENGINE_COLUMNS = ['cooking_start', 'cooking_end', 'cooking_event', 'load', 'load_count', 'timestamp_load']
+
+
+@pytest.fixture(scope='module')
+def df_raw():
+    return benchmark.synthetic_meter_data(n_meters=8, n_days=20, utc_share=0.2, seed=0)
+
+
+def assert_engines_equal(df_raw):
+    # Both passes of cooking_event of the script: on the raw recordings, and again after
+    # timestamp_issue and addtoevent
+    df_raw = cooking_session.remove_spikes(df_raw.copy())
+    df_pandas = cooking_session.cooking_event(df_raw, engine='pandas')
+    df_numpy = cooking_session.cooking_event(df_raw, engine='numpy')
+    assert df_pandas.cooking_start.sum() > 0
+    pd.testing.assert_frame_equal(df_numpy[ENGINE_COLUMNS], df_pandas[ENGINE_COLUMNS])
+
+    df_epc = cooking_session.addtoevent(cooking_session.timestamp_issue(df_pandas))
+    pd.testing.assert_frame_equal(cooking_session.cooking_event(df_epc, engine='numpy')[ENGINE_COLUMNS],
+                                  cooking_session.cooking_event(df_epc, engine='pandas')[ENGINE_COLUMNS])
+
+
+def test_numpy_engine(df_raw, monkeypatch):
+    # conditions_kernel as plain NumPy, also where numba compiles it
+    monkeypatch.setattr(cooking_session, 'conditions_kernel',
+                        getattr(cooking_session.conditions_kernel, 'py_func', cooking_session.conditions_kernel))
+    assert_engines_equal(df_raw)
+
+
+def test_numba_engine(df_raw):
+    pytest.importorskip('numba')
+    assert hasattr(cooking_session.conditions_kernel, 'py_func')
+    assert_engines_equal(df_raw)
+
+
+@pytest.mark.parametrize('n_meters, n_days', [(10, 30), (50, 60)])
+def test_lean_peak_memory(n_meters, n_days):
+    # The documented target of run_pipeline(..., lean=True), as by benchmark.py --check-lean
+    ratio = benchmark.lean_peak_ratio(benchmark.synthetic_meter_data(n_meters, n_days, utc_share=0.2, seed=0))
+    assert ratio <= cooking_session.LEAN_MEMORY_TARGET
+
+
+def test_parquet_round_trip(df_raw, tmp_path):
+    # df_epc as read back from Parquet, with the compact schema (e.g. a nullable Int64 cooking_event)
+    df_epc, df_only_events = cooking_session.meter_session(df_raw.copy())
+    cooking_session.write_parquet(df_epc, tmp_path / 'df_epc.parquet')
+    df_epc_read = cooking_session.read_parquet(tmp_path / 'df_epc.parquet', index='timestamp')
+    assert df_epc_read.cooking_event.dtype == 'Int64'
+    pd.testing.assert_frame_equal(cooking_session.only_events(df_epc_read), df_only_events,
+                                  check_dtype=False, rtol=1e-6)
+    for stage in (cooking_session.timestamp_issue, cooking_session.addtoevent):
+        pd.testing.assert_frame_equal(stage(df_epc_read.copy()),
+                                      stage(df_epc_read.astype({'cooking_event': float})), check_dtype=False)
+
+
+def test_refine_events_numbering(df_raw):
+    df_processed = cooking_session.cooking_event(cooking_session.remove_spikes(df_raw.copy()))
+    df_epc = cooking_session.timestamp_issue(df_processed)
+    # without rows added at the start or end, no cooking event changes
+    pd.testing.assert_frame_equal(cooking_session.refine_events(df_epc), df_epc)
+    # with them, the cooking events keep their numbers and 'cooking_start' still counts them (see renumber_meter)
+    df_refined = cooking_session.refine_events(cooking_session.addtoevent(df_epc.copy()))
+    assert set(df_refined.cooking_event.dropna()) <= set(df_epc.cooking_event.dropna())
+    assert df_refined.cooking_start.sum() == df_processed.cooking_start.sum()
+
+
+@pytest.mark.parametrize('params', [{}, {'t_between': 10, 'refine': True}])
+def test_update_events(df_raw, tmp_path, params):
+    # the recordings in daily batches (by the local day, and an empty one), with the state in tmp_path,
+    # give the cooking events of meter_session on the full history of each meter
+    df_raw = df_raw[df_raw.meter_number.isin(df_raw.meter_number.unique()[:3])]
+    day = cooking_session.normalize_timestamps(df_raw.copy()).timestamp.dt.normalize()
+    batches = [df_new for _, df_new in df_raw.groupby(day)]
+    batches.insert(3, df_raw.iloc[:0])
+    df_only_events = None
+    for df_new in batches:
+        df_new_events, replace_from = cooking_session.update_events(df_new, tmp_path, **params)
+        if df_only_events is None:
+            df_only_events = df_new_events
+        else:
+            df_only_events = pd.concat([df_only_events[~(
+                df_only_events.cooking_event >= df_only_events.meter_number.map(replace_from))], df_new_events])
+    for meter_number, df_raw_meter in df_raw.groupby('meter_number'):
+        pd.testing.assert_frame_equal(
+            df_only_events[df_only_events.meter_number == meter_number],
+            cooking_session.meter_session(df_raw_meter.copy(), **params)[1], check_dtype=False)
+
+
+@pytest.mark.parametrize('chunksize, params', [(500, {}), (500, {'t_between': 10}), (10 ** 6, {'t_between': 10})])
+def test_stream_events(df_raw, tmp_path, chunksize, params):
+    df_raw.to_csv(tmp_path / 'dataframe_raw.csv', index=False)
+    df_only_events = pd.concat(cooking_session.stream_events(tmp_path / 'dataframe_raw.csv', chunksize, **params))
+    pd.testing.assert_frame_equal(df_only_events, cooking_session.meter_session(df_raw.copy(), **params)[1],
+                                  check_dtype=False)
+
+
+def test_stream_events_unsorted(df_raw, tmp_path):
+    # a meter_number in a later chunk again would be numbered from the start again
+    df_first, df_second = [df_raw_meter for _, df_raw_meter in df_raw.groupby('meter_number')][:2]
+    pd.concat([df_first.iloc[:len(df_first) // 2], df_second, df_first.iloc[len(df_first) // 2:]]).to_csv(
+        tmp_path / 'dataframe_raw.csv', index=False)
+    with pytest.raises(ValueError, match='appears again'):
+        list(cooking_session.stream_events(tmp_path / 'dataframe_raw.csv', chunksize=500))
+
+
+@pytest.mark.parametrize('refine', [False, True])
+def test_parallel_meters(df_raw, refine):
+    df_epc, df_only_events = cooking_session.meter_session(df_raw.copy(), refine=refine)
+    df_epc_parallel, df_only_events_parallel = cooking_session.parallel_meters(
+        df_raw.copy(), max_workers=2, refine=refine)
+    pd.testing.assert_frame_equal(df_epc_parallel, df_epc)
+    pd.testing.assert_frame_equal(df_only_events_parallel, df_only_events)
+
+
+def test_meter_boundary():
+    # meter 1 with loads, meter 2 of one recording below the energy of meter 1 and meter 3 without loads
+    df_raw = pd.DataFrame({
+        'meter_number': [1, 1, 1, 2, 3, 3, 3],
+        'timezone': 'UTC+03:00',
+        'timestamp': ['2020-03-09 08:00:00', '2020-03-09 08:05:00', '2020-03-09 08:10:00', '2020-03-09 08:00:00',
+                      '2020-03-09 08:00:00', '2020-03-09 08:05:00', '2020-03-09 08:10:00'],
+        'energy': [10.0, 10.1, 10.2, 5.0, 7.0, 7.0, 7.0],
+        'power': [0.5, 0.5, 0.5, 0.0, 0.0, 0.0, 0.0]})
+    for engine in ['pandas', 'numpy']:
+        df_processed = cooking_session.cooking_event(df_raw, min_cooking_event=0, power_mean_min=0, engine=engine)
+        # 'load_count' starts again at each meter_number, so 'timestamp_load' is never that of another meter
+        assert df_processed.load_count.tolist() == [1, 2, 3, 4, 5, 5, 5]
+        assert (df_processed.timestamp_load[df_processed.meter_number == 3] == pd.Timestamp('2020-03-09 08:00')).all()
+        # the energy of meter 2 is not compared with that of meter 1 for too short cooking events
+        assert df_processed.cooking_event[df_processed.meter_number == 2].notnull().all()
+
+    # the duplicate cooking event of meter 1 is dropped, but not the recordings of meter 2 at its timestamps
+    df_processed = pd.DataFrame({
+        'meter_number': [1, 1, 1, 1, 2, 2],
+        'energy': [10.0, 10.5, 10.0, 10.5, 20.0, 21.0],
+        'cooking_event': [1.0, 1.0, 2.0, 2.0, 3.0, 3.0]},
+        index=pd.DatetimeIndex(['2020-03-09 08:00', '2020-03-09 08:05', '2020-03-09 08:10', '2020-03-09 08:15',
+                                '2020-03-09 08:10', '2020-03-09 08:15'], name='timestamp'))
+    df_epc = cooking_session.timestamp_issue(df_processed)
+    assert df_epc.cooking_event.tolist() == [1.0, 1.0, 3.0, 3.0]
+
+
+def test_ingest(df_raw):
+    # the recordings in three parts (with their 'id'), the second and third uploaded after the first and
+    # second fetch, give the cooking events of meter_session on all recordings of each meter
+    day = cooking_session.normalize_timestamps(df_raw.copy()).timestamp.dt.normalize()
+    days = day.drop_duplicates().sort_values()
+    parts = [df_raw[day < days.iloc[7]], df_raw[(day >= days.iloc[7]) & (day < days.iloc[14])],
+             df_raw[day >= days.iloc[14]]]
+
+    class UploadingSource(ingest.HttpSource):
+        def __init__(self, server):
+            super().__init__(server.url)
+            self.server, self.parts = server, parts[1:]
+
+        async def fetch(self, queue):
+            await super().fetch(queue)
+            if self.parts:
+                self.server.upload(self.parts.pop(0))
+
+    async def collect():
+        events = {}
+        with ingest.serve(parts[0]) as server:
+            async for meter_number, df_only_events, replace_from in ingest.ingest(
+                    UploadingSource(server), interval=0, rounds=3):
+                if meter_number in events:
+                    df_only_events = pd.concat([
+                        events[meter_number][events[meter_number].cooking_event < replace_from], df_only_events])
+                events[meter_number] = df_only_events
+        return events
+
+    events = asyncio.run(collect())
+    for meter_number, df_raw_meter in df_raw.groupby('meter_number'):
+        pd.testing.assert_frame_equal(events[meter_number], cooking_session.meter_session(df_raw_meter.copy())[1],
+                                      check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_utc_recordings(seed):
+    # the recordings of meters in 'UTC+00:00' give the same cooking events as in local time
+    df_only_events = cooking_session.meter_session(benchmark.synthetic_meter_data(4, 10, seed=seed, utc_share=0))[1]
+    pd.testing.assert_frame_equal(
+        cooking_session.meter_session(benchmark.synthetic_meter_data(4, 10, seed=seed, utc_share=0.5))[1],
+        df_only_events)
+
+
+def addtoevent_reference(df_epc):
+    # addtoevent as the script did it: the rows added to the frame and all rows sorted again, here by a
+    # stable sort, with the 'cooking_start' of the added rows as in addtoevent
+    df_epc = df_epc.reset_index()
+    df_epc.loc[df_epc.cooking_event.notnull() & (df_epc.cooking_event != df_epc.cooking_event.shift(-1))
+               & (df_epc.meter_number == df_epc.meter_number.shift(-1)),
+               'energy_gap_to_next'] = df_epc.energy.shift(-1) - df_epc.energy
+    df_added = cooking_session.extend_ending(df_epc[df_epc.energy_gap_to_next > 0].copy())
+    df_added['cooking_start'] = False
+    df_epc = pd.concat([df_epc, df_added]).sort_values(['meter_number', 'timestamp'], kind='stable',
+                                                       ignore_index=True)
+    for column in ['time_end', 'cooking_time', 'energy_end']:
+        df_epc[column] = cooking_session.lookup(df_epc.cooking_event, df_added.cooking_event, df_added[column])
+
+    first = (df_epc.cooking_event.notnull() & (df_epc.cooking_event != df_epc.cooking_event.shift())
+             & (df_epc.meter_number == df_epc.meter_number.shift()))
+    df_epc.loc[first, 'energy_gap_to_prev'] = df_epc.energy.diff()
+    df_added = cooking_session.extend_beginning(df_epc[df_epc.energy_gap_to_prev > 0].copy())
+    df_epc.loc[df_epc.energy_gap_to_prev > 0, 'cooking_start'] = False
+    df_epc = pd.concat([df_epc, df_added]).sort_values(['meter_number', 'timestamp'], kind='stable',
+                                                       ignore_index=True)
+    for column in ['time_start', 'cooking_time', 'energy_start']:
+        df_epc[column] = cooking_session.lookup(df_epc.cooking_event, df_added.cooking_event, df_added[column])
+    return df_epc.set_index('timestamp')
+
+
+@pytest.mark.parametrize('rows', ['sorted', 'shuffled', 'empty', 'one'])
+def test_addtoevent(df_raw, rows):
+    df_epc = cooking_session.timestamp_issue(cooking_session.cooking_event(cooking_session.remove_spikes(df_raw.copy())))
+    df_epc = {'sorted': df_epc, 'shuffled': df_epc.sample(frac=1, random_state=0), 'empty': df_epc.iloc[:0],
+              'one': df_epc.iloc[:1]}[rows]
+    pd.testing.assert_frame_equal(cooking_session.addtoevent(df_epc.copy()), addtoevent_reference(df_epc))
+
+
+def test_stage_cache(df_raw, tmp_path):
+    df_epc, df_only_events = cooking_session.meter_session(df_raw.copy())
+    with cooking_session.stage_cache(tmp_path) as stats:
+        cooking_session.meter_session(df_raw.copy())
+        misses = stats['misses']
+        df_epc_cached, df_only_events_cached = cooking_session.meter_session(df_raw.copy())
+        assert (stats['hits'], stats['misses']) == (misses, misses)
+        # another parameter is a miss
+        df_only_events_changed = cooking_session.meter_session(df_raw.copy(), t_between=10)[1]
+        assert stats['misses'] > misses
+    pd.testing.assert_frame_equal(df_epc_cached, df_epc)
+    pd.testing.assert_frame_equal(df_only_events_cached, df_only_events)
+    pd.testing.assert_frame_equal(df_only_events_changed, cooking_session.meter_session(df_raw.copy(), t_between=10)[1])
+
+
+def test_stage_cache_eviction(df_raw, tmp_path):
+    # above max_bytes the least recently used results are deleted, where a hit is a use
+    df_raw = cooking_session.remove_spikes(df_raw.copy())
+    paths = {}
+    with cooking_session.stage_cache(tmp_path):
+        for t_between in (10, 15, 20):
+            written = set(tmp_path.glob('*.arrow'))
+            cooking_session.cooking_event(df_raw, t_between=t_between)
+            paths[t_between], = set(tmp_path.glob('*.arrow')) - written
+    # written one after the other (regardless of the resolution of the modification times)
+    for seconds, path in enumerate(paths.values()):
+        os.utime(path, (time.time() - 100 + seconds,) * 2)
+    with cooking_session.stage_cache(tmp_path) as stats:
+        cooking_session.cooking_event(df_raw, t_between=10)
+        assert stats['hits'] == 1
+    with cooking_session.stage_cache(tmp_path, max_bytes=paths[10].stat().st_size + paths[20].stat().st_size):
+        pass
+    assert set(tmp_path.glob('*.arrow')) == {paths[10], paths[20]}
+
+
+@pytest.mark.parametrize('meter_number, start, end', [
+    (None, None, None), (546003, None, None), (546003, '2020-03-12', '2020-03-19'),
+    ([546001, 546005], '2020-03-15', None), ([546001, 999999], None, '2020-03-15 12:30'), (999999, None, None),
+    (546000, '2020-03-19', '2020-03-12')])
+def test_query(df_raw, tmp_path, meter_number, start, end):
+    # the rows of a query by the index (also saved and memory-mapped) are those of a mask over all rows
+    for df in cooking_session.meter_session(df_raw.copy()):
+        mask = np.ones(len(df), dtype=bool)
+        if meter_number is not None:
+            mask &= df.meter_number.isin(np.atleast_1d(meter_number)).to_numpy()
+        if start is not None:
+            mask &= df.index >= pd.Timestamp(start)
+        if end is not None:
+            mask &= df.index < pd.Timestamp(end)
+        index = cooking_session.build_index(df)
+        pd.testing.assert_frame_equal(cooking_session.query(df, index, meter_number, start, end), df[mask])
+        cooking_session.save_index(index, tmp_path / 'index')
+        pd.testing.assert_frame_equal(
+            cooking_session.query(df, cooking_session.load_index(tmp_path / 'index'), meter_number, start, end),
+            df[mask])
+
+
+@pytest.mark.parametrize('rollup, freq', [('daily', 'D'), ('weekly', 'W-SUN'), ('monthly', 'M')])
+def test_event_store(df_raw, tmp_path, rollup, freq):
+    # the rollups of build_event_store, and of add_events on a memory-mapped store (saved back to its
+    # directory), are the sums of groupby by meter_number and day, week (Monday to Sunday) or month
+    df_only_events = cooking_session.meter_session(df_raw.copy())[1]
+    period = df_only_events.index.to_period(freq).start_time.rename('period')
+    df_expected = df_only_events.assign(events=1).groupby([df_only_events.meter_number, period])[
+        ['events', 'energy_gen', 'cooking_time', 'cooking_cost']].sum()
+
+    store = cooking_session.build_event_store(df_only_events)
+    pd.testing.assert_frame_equal(
+        cooking_session.event_store_frame(store, rollup).set_index('meter_number', append=True).swaplevel(),
+        df_expected, check_dtype=False)
+
+    # the cooking events before the 12th day, then all from the 10th day on, which replace the later ones
+    days = df_only_events.index.normalize().unique().sort_values()
+    cooking_session.save_event_store(
+        cooking_session.build_event_store(df_only_events[df_only_events.index < days[12]]), tmp_path)
+    store = cooking_session.load_event_store(tmp_path)
+    assert isinstance(store['events']['start'], np.memmap)
+    cooking_session.add_events(store, df_only_events[df_only_events.index >= days[10]])
+    cooking_session.save_event_store(store, tmp_path)
+    pd.testing.assert_frame_equal(
+        cooking_session.event_store_frame(cooking_session.load_event_store(tmp_path), rollup).set_index(
+            'meter_number', append=True).swaplevel(), df_expected, check_dtype=False)